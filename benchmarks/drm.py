@@ -0,0 +1,204 @@
+'''
+Microbenchmark of KoboDrmRemover.RemoveDrm on locally generated KDRM encrypted EPUBs.
+
+    python -m benchmarks.drm --entries 20 --entries 200 --entry-size 64 --entry-size 1024 \
+        --encrypted 0.5 --encrypted 1 --workers 1 --workers 4
+
+Every combination of the options is run. Each run happens in a fresh subprocess so its peak RSS
+can be measured on its own.
+'''
+
+import base64
+import binascii
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Dict, Union
+
+import click
+from Crypto.Cipher import AES
+from Crypto.Util import Padding
+from tabulate import tabulate
+
+from benchmarks.stubServer import Words
+from kobodl.koboDrmRemover import KoboDrmRemover
+
+DeviceId = 'd' * 64
+UserId = 'benchmark-user'
+
+
+def make_encrypted_epub(
+    path: str, entries: int, entrySize: int, encryptedShare: float, content: str, seed: int = 0
+) -> Dict[str, str]:
+    '''write an EPUB encrypted the way Kobo does it and return its content keys'''
+    rng = random.Random(seed)
+    # The same key scheme as KoboDrmRemover: the content keys are encrypted with the second half of
+    # sha256(DeviceId + UserId).
+    userKey = binascii.a2b_hex(hashlib.sha256((DeviceId + UserId).encode()).hexdigest()[32:])
+    userAes = AES.new(userKey, AES.MODE_ECB)
+    encryptedEntries = round(entries * encryptedShare)
+    contentKeys = {}
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr('mimetype', b'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        for index in range(entries):
+            name = f'OEBPS/entry{index}.xhtml'
+            if content == 'text':
+                text = ' '.join(rng.choices(Words, k=entrySize // 4 + 1)).encode()[:entrySize]
+            else:
+                text = rng.randbytes(entrySize)
+            if index < encryptedEntries:
+                contentKey = rng.randbytes(16)
+                contentKeys[name] = base64.b64encode(userAes.encrypt(contentKey)).decode()
+                text = AES.new(contentKey, AES.MODE_ECB).encrypt(Padding.pad(text, AES.block_size))
+            epub.writestr(name, text)
+    return contentKeys
+
+
+def get_peak_rss() -> Union[int, None]:
+    '''peak resident set size of this process in bytes, where the platform can tell'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_once(inputPath: str, outputPath: str, keysPath: str, workers: int) -> dict:
+    '''runs in the subprocess'''
+    with open(keysPath) as f:
+        contentKeys = json.load(f)
+    drmRemover = KoboDrmRemover(DeviceId, UserId)
+    baselineRss = get_peak_rss()
+    start = time.perf_counter()
+    drmRemover.RemoveDrm(inputPath, outputPath, contentKeys, workers=workers)
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'baseline_rss': baselineRss,
+        'peak_rss': get_peak_rss(),
+        'output_size': os.path.getsize(outputPath),
+    }
+
+
+def run_in_subprocess(inputPath: str, outputPath: str, keysPath: str, workers: int) -> dict:
+    command = [sys.executable, '-m', 'benchmarks.drm', '--workers', str(workers)]
+    command += ['--run-once', inputPath, outputPath, keysPath]
+    result = subprocess.run(command, check=True, capture_output=True, text=True)
+    return json.loads(result.stdout)
+
+
+def format_mib(size: Union[int, None]) -> str:
+    return '-' if size is None else f'{size / 1024 / 1024:.1f}'
+
+
+@click.command()
+@click.option('--entries', type=click.INT, multiple=True, help='entries per EPUB, default 50')
+@click.option('--entry-size', type=click.INT, multiple=True, help='KiB per entry, default 256')
+@click.option(
+    '--encrypted', type=click.FLOAT, multiple=True, help='share of entries encrypted, default 1'
+)
+@click.option('--workers', type=click.INT, multiple=True, help='RemoveDrm workers, default 1')
+@click.option(
+    '--content',
+    type=click.Choice(['text', 'random']),
+    default='text',
+    help='compressible text, or random bytes that don\'t compress',
+)
+@click.option(
+    '--repeat', type=click.INT, default=3, help='runs per combination; the median is shown'
+)
+@click.option('--json', 'asJson', is_flag=True, help='print the results as JSON')
+@click.option('--run-once', 'runOnce', nargs=3, type=click.STRING, hidden=True)
+def main(entries, entry_size, encrypted, workers, content, repeat, asJson, runOnce):
+    if runOnce:
+        click.echo(json.dumps(run_once(*runOnce, workers[0] if workers else 1)))
+        return
+
+    workDir = tempfile.mkdtemp(prefix='kobodl-drm-benchmark-')
+    results = []
+    try:
+        for entryCount, entrySize, encryptedShare in itertools.product(
+            entries or [50], entry_size or [256], encrypted or [1.0]
+        ):
+            inputPath = os.path.join(workDir, 'input.epub')
+            keysPath = os.path.join(workDir, 'keys.json')
+            contentKeys = make_encrypted_epub(
+                inputPath, entryCount, entrySize * 1024, encryptedShare, content
+            )
+            with open(keysPath, 'w') as f:
+                json.dump(contentKeys, f)
+
+            for workerCount in workers or [1]:
+                outputPath = os.path.join(workDir, 'output.epub')
+                runs = [
+                    run_in_subprocess(inputPath, outputPath, keysPath, workerCount)
+                    for _ in range(repeat)
+                ]
+                results.append(
+                    {
+                        'entries': entryCount,
+                        'entry_size_kib': entrySize,
+                        'encrypted_share': encryptedShare,
+                        'workers': workerCount,
+                        'input_size': os.path.getsize(inputPath),
+                        'output_size': runs[-1]['output_size'],
+                        'seconds': statistics.median(run['seconds'] for run in runs),
+                        'peak_rss': max((run['peak_rss'] or 0) for run in runs) or None,
+                        # How much RemoveDrm itself added on top of the interpreter and the imports.
+                        'rss_increase': max(
+                            (run['peak_rss'] or 0) - (run['baseline_rss'] or 0) for run in runs
+                        )
+                        or None,
+                    }
+                )
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    if asJson:
+        click.echo(json.dumps(results, indent=2))
+        return
+    headers = [
+        'entries',
+        'KiB/entry',
+        'encrypted',
+        'workers',
+        'seconds',
+        'MiB/s',
+        'peak RSS MiB',
+        'RSS over baseline MiB',
+        'input MiB',
+        'output MiB',
+    ]
+    rows = []
+    for result in results:
+        dataSize = result['entries'] * result['entry_size_kib'] * 1024
+        rows.append(
+            [
+                result['entries'],
+                result['entry_size_kib'],
+                f"{result['encrypted_share']:.0%}",
+                result['workers'],
+                f"{result['seconds']:.3f}",
+                f"{dataSize / 1024 / 1024 / result['seconds']:.1f}",
+                format_mib(result['peak_rss']),
+                format_mib(result['rss_increase']),
+                format_mib(result['input_size']),
+                format_mib(result['output_size']),
+            ]
+        )
+    click.echo(tabulate(rows, headers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+'''
+End-to-end benchmark of kobodl against the local Kobo API stand-in in stubServer.py.
+
+    python -m benchmarks.e2e --books 200 --book-size 2 --jobs 4 --pipeline
+
+Nothing is sent to the real Kobo servers. Everything kobodl writes (settings, caches, downloads) goes to a
+temporary directory that is removed afterwards.
+'''
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import click
+from tabulate import tabulate
+
+from benchmarks.stubServer import KoboStubServer, StubLibrary
+from kobodl import actions
+from kobodl.globals import Globals
+from kobodl.kobo import Kobo
+from kobodl.metrics import Metrics
+from kobodl.settings import Settings, User
+
+
+def run_benchmark(
+    library: StubLibrary,
+    jobs: int,
+    pipeline: bool,
+    decryptWorkers: int,
+    audiobookJobs: int,
+    verbose: bool,
+) -> dict:
+    workDir = tempfile.mkdtemp(prefix='kobodl-benchmark-')
+    storeApiUrl = Kobo.StoreApiUrl
+    Metrics.Reset()
+    try:
+        with KoboStubServer(library) as stub:
+            Kobo.StoreApiUrl = stub.Url
+            Globals.Settings = Settings(os.path.join(workDir, 'kobodl.json'))
+            user = User(
+                Email='benchmark@example.com',
+                DeviceId=library.DeviceId,
+                AccessToken='benchmark-access-token',
+                RefreshToken='benchmark-refresh-token',
+                UserId=library.UserId,
+                UserKey='benchmark-user-key',
+            )
+            Globals.Settings.UserList.users.append(user)
+            outputDir = os.path.join(workDir, 'downloads')
+
+            # kobodl reports every book; keep that out of the way of the results unless asked for.
+            output = contextlib.ExitStack()
+            if not verbose:
+                output.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                output.enter_context(contextlib.redirect_stderr(io.StringIO()))
+            with output:
+                start = time.perf_counter()
+                books = list(actions.ListBooks([user], True, None, fullSync=True))
+                fullListSeconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                list(actions.ListBooks([user], True, None))
+                incrementalListSeconds = time.perf_counter() - start
+
+                statsBefore = stub.GetStats()
+                start = time.perf_counter()
+                actions.GetBookOrBooks(
+                    user,
+                    outputDir,
+                    r'{Author} - {Title} {ShortRevisionId}',
+                    jobs=jobs,
+                    audiobookJobs=audiobookJobs,
+                    decryptWorkers=decryptWorkers,
+                    pipeline=pipeline,
+                )
+                downloadSeconds = time.perf_counter() - start
+                statsAfter = stub.GetStats()
+
+            downloaded = len(os.listdir(outputDir)) if os.path.isdir(outputDir) else 0
+            transferred = statsAfter.BytesServed - statsBefore.BytesServed
+            return {
+                'books': len(books),
+                'downloaded': downloaded,
+                'full_list_seconds': fullListSeconds,
+                'incremental_list_seconds': incrementalListSeconds,
+                'download_seconds': downloadSeconds,
+                'megabytes_transferred': transferred / 1024 / 1024,
+                'megabytes_per_second': transferred / 1024 / 1024 / downloadSeconds,
+                'books_per_minute': downloaded / downloadSeconds * 60,
+                'requests': statsAfter.Requests,
+                'requests_by_path': statsAfter.RequestsByPath,
+                'metrics': Metrics.GetSummary(),
+            }
+    finally:
+        Kobo.StoreApiUrl = storeApiUrl
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+@click.command()
+@click.option('--books', type=click.INT, default=50, help='number of ebooks in the library')
+@click.option('--audiobooks', type=click.INT, default=0, help='number of audiobooks in the library')
+@click.option('--book-size', type=click.FLOAT, default=2, help='MiB of text per ebook')
+@click.option('--audiobook-parts', type=click.INT, default=4)
+@click.option('--part-size', type=click.FLOAT, default=4, help='MiB per audiobook part')
+@click.option('--page-size', type=click.INT, default=50, help='entitlements per library_sync page')
+@click.option('--latency', type=click.FLOAT, default=0, help='milliseconds added to every response')
+@click.option('-j', '--jobs', type=click.INT, default=1)
+@click.option('--pipeline', is_flag=True)
+@click.option('--decrypt-workers', type=click.INT, default=1)
+@click.option('--audiobook-jobs', type=click.INT, default=4)
+@click.option('--json', 'asJson', is_flag=True, help='print the results as JSON')
+@click.option('-v', '--verbose', is_flag=True, help="show kobodl's own output")
+def main(
+    books,
+    audiobooks,
+    book_size,
+    audiobook_parts,
+    part_size,
+    page_size,
+    latency,
+    jobs,
+    pipeline,
+    decrypt_workers,
+    audiobook_jobs,
+    asJson,
+    verbose,
+):
+    library = StubLibrary(
+        Books=books,
+        Audiobooks=audiobooks,
+        BookSize=int(book_size * 1024 * 1024),
+        AudiobookParts=audiobook_parts,
+        AudiobookPartSize=int(part_size * 1024 * 1024),
+        PageSize=page_size,
+        Latency=latency / 1000,
+    )
+    results = run_benchmark(library, jobs, pipeline, decrypt_workers, audiobook_jobs, verbose)
+    if asJson:
+        click.echo(json.dumps(results, indent=2))
+        return
+    rows = [
+        ('books in library', results['books']),
+        ('books downloaded', results['downloaded']),
+        ('full list (s)', f"{results['full_list_seconds']:.3f}"),
+        ('incremental list (s)', f"{results['incremental_list_seconds']:.3f}"),
+        ('download (s)', f"{results['download_seconds']:.3f}"),
+        ('transferred (MiB)', f"{results['megabytes_transferred']:.1f}"),
+        ('download MiB/s', f"{results['megabytes_per_second']:.1f}"),
+        ('books per minute', f"{results['books_per_minute']:.1f}"),
+        ('requests', results['requests']),
+    ]
+    click.echo(tabulate(rows, tablefmt='simple'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+'''
+Startup benchmark of the kobodl CLI.
+
+    python -m benchmarks.startup --repeat 10 --max-import-ms 150
+
+Every command runs in a fresh interpreter with -X importtime, against a temporary config file. The
+command fails if one of them imports a module it shouldn't need, or with --max-import-ms, if its
+median import time is over the budget, so that slower startup doesn't go unnoticed.
+'''
+
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+import click
+from tabulate import tabulate
+
+from kobodl.settings import Settings, User
+
+WebModules = ['flask', 'werkzeug', 'jinja2', 'kobodl.app']
+NetworkModules = ['requests', 'kobodl.kobo', 'kobodl.actions']
+DrmModules = ['Crypto', 'kobodl.koboDrmRemover']
+TableModules = ['tabulate']
+
+# The arguments of each command, and the modules it must not import.
+Commands: List[Tuple[List[str], List[str]]] = [
+    (['user', 'list'], WebModules + NetworkModules + DrmModules),
+    (['user', 'rm', 'nobody@example.com'], WebModules + NetworkModules + DrmModules + TableModules),
+    (['book', 'get', '--help'], WebModules + DrmModules + TableModules),
+    (['serve', '--help'], WebModules + NetworkModules + DrmModules + TableModules),
+]
+
+
+def parse_importtime(output: str) -> Tuple[float, List[str]]:
+    '''
+    the milliseconds spent importing kobodl and everything it imported later, and the names of all
+    modules imported by the process
+    '''
+    seconds = 0
+    modules = []
+    counting = False
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:') :].split('|')
+        modules.append(name.strip())
+        # Top-level imports aren't indented. Those before kobodl are the interpreter's own startup.
+        topLevel = name[1:2] != ' '
+        if topLevel and name.strip() == 'kobodl':
+            counting = True
+        if topLevel and counting:
+            seconds += int(cumulative) / 1000000
+    return seconds * 1000, modules
+
+
+def run_command(configPath: str, arguments: List[str]) -> dict:
+    command = [sys.executable, '-X', 'importtime', '-m', 'kobodl', '--config', configPath]
+    start = time.perf_counter()
+    result = subprocess.run(command + arguments, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise click.ClickException(f"{' '.join(arguments)} failed:\n{result.stderr[-2000:]}")
+    importMilliseconds, modules = parse_importtime(result.stderr)
+    return {'process_ms': seconds * 1000, 'import_ms': importMilliseconds, 'modules': modules}
+
+
+def find_unexpected(modules: List[str], forbidden: List[str]) -> List[str]:
+    return sorted(
+        {
+            module
+            for module in forbidden
+            for name in modules
+            if name == module or name.startswith(module + '.')
+        }
+    )
+
+
+@click.command()
+@click.option('--repeat', type=click.INT, default=5, help='runs per command; the median is shown')
+@click.option(
+    '--max-import-ms', type=click.FLOAT, help='fail if a command takes longer to import kobodl'
+)
+@click.option('--json', 'asJson', is_flag=True, help='print the results as JSON')
+def main(repeat, max_import_ms, asJson):
+    workDir = tempfile.mkdtemp(prefix='kobodl-startup-benchmark-')
+    results = []
+    try:
+        # A user in the config, so that loading the settings is part of what is measured.
+        configPath = os.path.join(workDir, 'kobodl.json')
+        settings = Settings(configPath)
+        settings.UserList.users.append(User(Email='benchmark@example.com', DeviceId='d' * 64))
+        settings.Save()
+
+        for arguments, forbidden in Commands:
+            runs = [run_command(configPath, arguments) for _ in range(repeat)]
+            results.append(
+                {
+                    'command': ' '.join(arguments),
+                    'process_ms': statistics.median(run['process_ms'] for run in runs),
+                    'import_ms': statistics.median(run['import_ms'] for run in runs),
+                    'modules': len(runs[-1]['modules']),
+                    'unexpected_modules': find_unexpected(runs[-1]['modules'], forbidden),
+                }
+            )
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    if asJson:
+        click.echo(json.dumps(results, indent=2))
+    else:
+        headers = ['command', 'process ms', 'import ms', 'modules', 'unexpected modules']
+        rows = [
+            [
+                result['command'],
+                f"{result['process_ms']:.1f}",
+                f"{result['import_ms']:.1f}",
+                result['modules'],
+                ', '.join(result['unexpected_modules']) or '-',
+            ]
+            for result in results
+        ]
+        click.echo(tabulate(rows, headers))
+
+    failures = [
+        f"{result['command']} imports {', '.join(result['unexpected_modules'])}"
+        for result in results
+        if result['unexpected_modules']
+    ]
+    if max_import_ms is not None:
+        failures += [
+            f"{result['command']} took {result['import_ms']:.1f} ms to import, over {max_import_ms} ms"
+            for result in results
+            if result['import_ms'] > max_import_ms
+        ]
+    if failures:
+        raise click.ClickException('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+import base64
+import binascii
+import dataclasses
+import hashlib
+import http.server
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+import zipfile
+from typing import Dict, List, Tuple, Union
+
+from Crypto.Cipher import AES
+from Crypto.Util import Padding
+
+# Words the synthetic chapters are made of, so they compress about as well as real text does.
+Words = (
+    'the of and to in a is that for it as was with be by on not he i this are or his from at which '
+    'but have an they you were her she there one all we their can has more when will would been if '
+    'no what so out up into them some could time only new these two may first then do any like my '
+    'now over such our man me even most made after also did many before must through back years'
+).split()
+
+
+@dataclasses.dataclass
+class StubLibrary:
+    Books: int = 100
+    Audiobooks: int = 0
+    # Size of the text in each EPUB, before encryption and compression.
+    BookSize: int = 2 * 1024 * 1024
+    Chapters: int = 10
+    AudiobookParts: int = 4
+    AudiobookPartSize: int = 4 * 1024 * 1024
+    # Entitlements per library_sync page.
+    PageSize: int = 50
+    # Added to every response, to stand in for the round trip to the real servers.
+    Latency: float = 0.0
+    DeviceId: str = 'b' * 64
+    UserId: str = 'benchmark-user'
+
+
+@dataclasses.dataclass
+class StubStats:
+    Requests: int = 0
+    BytesServed: int = 0
+    RequestsByPath: Dict[str, int] = dataclasses.field(default_factory=dict)
+
+
+class KoboStubServer:
+    '''
+    Local stand-in for the parts of the Kobo API kobodl uses:
+    /v1/initialization, paged library_sync with sync tokens, content_access_book with ContentKeys,
+    and download URLs that redirect to a storage host serving KDRM encrypted EPUBs and audiobook
+    spines.
+    Every book shares one synthetic EPUB, which is built once at start-up.
+    '''
+
+    def __init__(self, library: StubLibrary, host: str = '127.0.0.1', port: int = 0):
+        self.Library = library
+        self.Stats = StubStats()
+        self.StatsLock = threading.Lock()
+        self.Epub, self.ContentKeys = KoboStubServer.__MakeEncryptedEpub(library)
+        self.AudiobookPart = random.Random(1).randbytes(library.AudiobookPartSize)
+        # kobodl only resumes a download with If-Range set to one of these.
+        self.EpubETag = '"' + hashlib.sha256(self.Epub).hexdigest() + '"'
+        self.AudiobookPartETag = '"' + hashlib.sha256(self.AudiobookPart).hexdigest() + '"'
+        self.Entitlements = KoboStubServer.__MakeEntitlements(library)
+        handler = KoboStubServer.__MakeHandler(self)
+        self.Server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.Server.daemon_threads = True
+        self.Url = f'http://{host}:{self.Server.server_port}'
+        self.Thread = None
+
+    def Start(self) -> 'KoboStubServer':
+        self.Thread = threading.Thread(target=self.Server.serve_forever, daemon=True)
+        self.Thread.start()
+        return self
+
+    def Stop(self) -> None:
+        self.Server.shutdown()
+        self.Server.server_close()
+
+    def __enter__(self) -> 'KoboStubServer':
+        return self.Start()
+
+    def __exit__(self, *args) -> None:
+        self.Stop()
+
+    def GetStats(self) -> StubStats:
+        with self.StatsLock:
+            return dataclasses.replace(self.Stats, RequestsByPath=dict(self.Stats.RequestsByPath))
+
+    def Count(self, route: str, bytesServed: int) -> None:
+        with self.StatsLock:
+            self.Stats.Requests += 1
+            self.Stats.BytesServed += bytesServed
+            self.Stats.RequestsByPath[route] = self.Stats.RequestsByPath.get(route, 0) + 1
+
+    @staticmethod
+    def __MakeText(rng: random.Random, size: int) -> bytes:
+        paragraphs = []
+        length = 0
+        while length < size:
+            paragraph = '<p>' + ' '.join(rng.choices(Words, k=120)) + '.</p>\n'
+            paragraphs.append(paragraph)
+            length += len(paragraph)
+        return ''.join(paragraphs).encode()[:size]
+
+    @staticmethod
+    def __MakeEncryptedEpub(library: StubLibrary) -> Tuple[bytes, List[dict]]:
+        rng = random.Random(0)
+        userKey = binascii.a2b_hex(
+            hashlib.sha256((library.DeviceId + library.UserId).encode()).hexdigest()[32:]
+        )
+        contentKeys = []
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as epub:
+            epub.writestr('mimetype', b'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+            epub.writestr('META-INF/container.xml', b'<container/>')
+            # A cover that isn't encrypted, like the fonts and images of real books.
+            epub.writestr('OEBPS/cover.jpg', rng.randbytes(200 * 1024))
+            chapterSize = max(library.BookSize // max(library.Chapters, 1), 1)
+            for chapter in range(library.Chapters):
+                name = f'OEBPS/chapter{chapter}.xhtml'
+                contentKey = rng.randbytes(16)
+                data = KoboStubServer.__MakeText(rng, chapterSize)
+                # Kobo's ContentKeys are the per-file keys, encrypted with the device and user key.
+                encryptedKey = AES.new(userKey, AES.MODE_ECB).encrypt(contentKey)
+                contentKeys.append({'Name': name, 'Value': base64.b64encode(encryptedKey).decode()})
+                encryptedData = AES.new(contentKey, AES.MODE_ECB).encrypt(Padding.pad(data, 16))
+                epub.writestr(name, encryptedData)
+        return output.getvalue(), contentKeys
+
+    @staticmethod
+    def __MakeEntitlements(library: StubLibrary) -> List[dict]:
+        rng = random.Random(2)
+        entitlements = []
+        for index in range(library.Books + library.Audiobooks):
+            revisionId = str(uuid.UUID(int=rng.getrandbits(128)))
+            metadata = {
+                'RevisionId': revisionId,
+                'Title': f'Book {index} ' + ' '.join(rng.choices(Words, k=3)).title(),
+                'ContributorRoles': [{'Name': f'Author {index % 37}', 'Role': 'Author'}],
+            }
+            if index < library.Books:
+                entitlement = {
+                    'BookEntitlement': {
+                        'Id': revisionId,
+                        'Accessibility': 'Full',
+                        'IsRemoved': False,
+                    },
+                    'BookMetadata': metadata,
+                }
+            else:
+                # DownloadUrls are filled in per request, they need the server's address.
+                entitlement = {
+                    'AudiobookEntitlement': {'Id': revisionId, 'IsRemoved': False},
+                    'AudiobookMetadata': metadata,
+                }
+            entitlements.append({'NewEntitlement': entitlement})
+        return entitlements
+
+    @staticmethod
+    def __MakeHandler(stub: 'KoboStubServer'):
+        class Handler(KoboStubHandler):
+            Stub = stub
+
+        return Handler
+
+
+class KoboStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    Stub: Union[KoboStubServer, None] = None
+
+    Routes = [
+        ('HandleInitialization', re.compile(r'^/v1/initialization$')),
+        ('HandleAuth', re.compile(r'^/v1/auth/(refresh|device)$')),
+        ('HandleLibrarySync', re.compile(r'^/v1/library/sync$')),
+        ('HandleContentAccessBook', re.compile(r'^/v1/products/books/(?P<id>[^/]+)/access$')),
+        ('HandleDownload', re.compile(r'^/download/(?P<id>[^/]+)$')),
+        ('HandleStorage', re.compile(r'^/storage/(?P<id>[^/]+)\.epub$')),
+        ('HandleSpine', re.compile(r'^/audiobook/(?P<id>[^/]+)/spine$')),
+        ('HandlePart', re.compile(r'^/storage/(?P<id>[^/]+)/part(?P<part>\d+)\.mp3$')),
+    ]
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.__Dispatch()
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.__Dispatch()
+
+    def __Dispatch(self) -> None:
+        if self.Stub.Library.Latency > 0:
+            time.sleep(self.Stub.Library.Latency)
+        url = urllib.parse.urlsplit(self.path)
+        for handlerName, pattern in KoboStubHandler.Routes:
+            match = pattern.match(url.path)
+            if match:
+                getattr(self, handlerName)(match, url)
+                return
+        self.__SendJson(404, {'error': 'not found'}, 'unknown')
+
+    def __SendJson(self, status: int, data, route: str, headers: Dict[str, str] = {}) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.Stub.Count(route, len(body))
+
+    def __SendBytes(self, data: bytes, etag: str, route: str) -> None:
+        # Downloads are resumed with Range requests, so support the single-range form kobodl sends.
+        start = 0
+        rangeHeader = self.headers.get('Range', '')
+        match = re.match(r'^bytes=(\d+)-$', rangeHeader)
+        if match and self.headers.get('If-Range', etag) != etag:
+            # The client's partial copy is of another file; it gets the whole file instead.
+            match = None
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                self.Stub.Count(route, 0)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(memoryview(data)[start:])
+        self.Stub.Count(route, len(data) - start)
+
+    def HandleInitialization(self, match, url) -> None:
+        base = self.Stub.Url
+        resources = {
+            'library_sync': f'{base}/v1/library/sync',
+            'content_access_book': f'{base}/v1/products/books/{{ProductId}}/access',
+            'user_wishlist': f'{base}/v1/user/wishlist',
+        }
+        self.__SendJson(200, {'Resources': resources}, 'initialization')
+
+    def HandleAuth(self, match, url) -> None:
+        tokens = {
+            'TokenType': 'Bearer',
+            'AccessToken': 'benchmark-access-token',
+            'RefreshToken': 'benchmark-refresh-token',
+            'UserKey': 'benchmark-user-key',
+        }
+        self.__SendJson(200, tokens, 'auth')
+
+    def HandleLibrarySync(self, match, url) -> None:
+        # Sync tokens are "page:<n>" for the next page, or "done" once everything was sent.
+        entitlements = self.Stub.Entitlements
+        pageSize = self.Stub.Library.PageSize
+        syncToken = self.headers.get('x-kobo-synctoken', '')
+        if syncToken == 'done':
+            self.__SendJson(200, [], 'library_sync', {'x-kobo-synctoken': 'done'})
+            return
+        page = int(syncToken[len('page:') :]) if syncToken.startswith('page:') else 0
+        items = [
+            self.__WithDownloadUrls(item)
+            for item in entitlements[page * pageSize : (page + 1) * pageSize]
+        ]
+        headers = {'x-kobo-synctoken': 'done'}
+        if (page + 1) * pageSize < len(entitlements):
+            headers = {'x-kobo-synctoken': f'page:{page + 1}', 'x-kobo-sync': 'continue'}
+        self.__SendJson(200, items, 'library_sync', headers)
+
+    def __WithDownloadUrls(self, item: dict) -> dict:
+        metadata = item['NewEntitlement'].get('AudiobookMetadata')
+        if metadata is None:
+            return item
+        url = f'{self.Stub.Url}/audiobook/{metadata["RevisionId"]}/spine'
+        metadata = {**metadata, 'DownloadUrls': [{'DrmType': 'None', 'Url': url}]}
+        return {'NewEntitlement': {**item['NewEntitlement'], 'AudiobookMetadata': metadata}}
+
+    def HandleContentAccessBook(self, match, url) -> None:
+        productId = match.group('id')
+        contentUrl = {
+            'DRMType': 'KDRM',
+            'UrlFormat': 'EPUB3',
+            'DownloadUrl': f'{self.Stub.Url}/download/{productId}',
+        }
+        data = {'ContentKeys': self.Stub.ContentKeys, 'ContentUrls': [contentUrl]}
+        self.__SendJson(200, data, 'content_access_book')
+
+    def HandleDownload(self, match, url) -> None:
+        # storedownloads.kobo.com answers with a redirect to the storage host; so does the stand-in.
+        self.send_response(302)
+        self.send_header('Location', f'{self.Stub.Url}/storage/{match.group("id")}.epub')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.Stub.Count('download', 0)
+
+    def HandleStorage(self, match, url) -> None:
+        self.__SendBytes(self.Stub.Epub, self.Stub.EpubETag, 'storage')
+
+    def HandleSpine(self, match, url) -> None:
+        productId = match.group('id')
+        spine = [
+            {
+                'Id': str(part),
+                'Url': f'{self.Stub.Url}/storage/{productId}/part{part}.mp3',
+                'FileExtension': 'mp3',
+            }
+            for part in range(self.Stub.Library.AudiobookParts)
+        ]
+        self.__SendJson(200, {'Spine': spine}, 'spine')
+
+    def HandlePart(self, match, url) -> None:
+        self.__SendBytes(self.Stub.AudiobookPart, self.Stub.AudiobookPartETag, 'part')
@@ -1,14 +1,64 @@
+import json
 import sys
+from typing import Callable, Dict, List, Union
 
 import click
 
-from kobodl.app import app
 from kobodl.debug import debug_data
 from kobodl.globals import Globals
+from kobodl.metrics import Metrics
 from kobodl.settings import Settings
 
+# Only the modules the invoked subcommand needs are imported, so that e.g. `kobodl user list` doesn't load
+# Flask, requests or Crypto. Run benchmarks/startup.py after adding imports here or in kobodl.settings.
 
-@click.group()
+
+class LazyGroup(click.Group):
+    '''a click group whose subcommands are imported the first time they are looked up'''
+
+    def __init__(
+        self,
+        *args,
+        lazyCommands: Union[Dict[str, Callable[[], click.Command]], None] = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.LazyCommands = lazyCommands or {}
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted(set(super().list_commands(ctx)) | set(self.LazyCommands))
+
+    def get_command(self, ctx: click.Context, name: str) -> click.Command:
+        if name not in self.commands and name in self.LazyCommands:
+            self.add_command(self.LazyCommands[name](), name)
+        return super().get_command(ctx, name)
+
+
+# Plain import statements rather than module names in strings, so pyinstaller still finds the modules.
+def load_book_command() -> click.Command:
+    from kobodl.commands.book import book
+
+    return book
+
+
+def load_user_command() -> click.Command:
+    from kobodl.commands.user import user
+
+    return user
+
+
+def parse_rate(ctx, param, value):
+    if value is None:
+        return None
+    from kobodl.transport import RateLimiter
+
+    try:
+        return RateLimiter.ParseRate(value)
+    except ValueError:
+        raise click.BadParameter(f'{value} is not a rate like 500k or 2M')
+
+
+@click.group(cls=LazyGroup, lazyCommands={'book': load_book_command, 'user': load_user_command})
 @click.option(
     '--fmt',
     type=click.STRING,
@@ -25,11 +75,31 @@ from kobodl.settings import Settings
     is_flag=True,
     help="enable the debug log",
 )
+@click.option(
+    '--limit-rate',
+    type=click.STRING,
+    callback=parse_rate,
+    help=(
+        'limit the combined download speed, in bytes per second. '
+        'Accepts k, M and G suffixes, e.g. 500k'
+    ),
+)
+@click.option(
+    '--metrics',
+    is_flag=True,
+    help='print request, transfer and decryption metrics as JSON to stderr when done',
+)
 @click.version_option()
 @click.pass_context
-def cli(ctx, fmt, config, debug):
+def cli(ctx, fmt, config, debug, limit_rate, metrics):
     Globals.Settings = Settings(config)
     Globals.Debug = debug
+    if limit_rate is not None:
+        from kobodl.transport import Transport
+
+        Transport.RateLimiter.SetRate(limit_rate)
+    if metrics:
+        ctx.call_on_close(lambda: click.echo(json.dumps(Metrics.GetSummary(), indent=2), err=True))
     ctx.obj = {
         'fmt': fmt,
         'debug': debug,
@@ -48,11 +118,11 @@ def cli(ctx, fmt, config, debug):
     default='kobo_downloads',
 )
 def serve(host, port, debug, output_dir):
+    from kobodl.app import app
+
     Globals.Debug = debug
     app.config['output_dir'] = output_dir
     app.run(host, port, debug)
 
 
 cli.add_command(serve)
-
-from kobodl.commands import book, user  # isort:skip noqa: F401 E402
@@ -1,12 +1,28 @@
+import concurrent.futures
 import json
 import os
 import platform
-from typing import List, TextIO, Tuple, Union, Generator
+import queue
+import sqlite3
+import threading
+from typing import Callable, Generator, List, TextIO, Tuple, Union
 
 import click
 
+from kobodl.catalog import CatalogEntry, DownloadCatalog
+from kobodl.debug import debug_data
 from kobodl.globals import Globals
-from kobodl.kobo import Book, BookType, Kobo, KoboException, NotAuthenticatedException
+from kobodl.kobo import (
+    Book,
+    BookType,
+    DownloadFailedException,
+    DownloadInfo,
+    Kobo,
+    KoboException,
+    NotAuthenticatedException,
+)
+from kobodl.library import ExportFingerprints, LibraryExport, LibraryStore
+from kobodl.metrics import Metrics
 from kobodl.settings import User
 
 SUPPORTED_BOOK_TYPES = [
@@ -76,6 +92,13 @@ def __GetBookMetadata(entitlement: dict) -> Tuple[dict, BookType]:
     return None, None
 
 
+def __GetEntitlementProductId(newEntitlement: dict) -> Union[str, None]:
+    for key in ['BookMetadata', 'AudiobookMetadata', 'BookSubscriptionEntitlement']:
+        if key in newEntitlement:
+            return Kobo.GetProductId(newEntitlement[key])
+    return None
+
+
 def __IsBookArchived(newEntitlement: dict) -> bool:
     keys = newEntitlement.keys()
     bookEntitlement: dict = {}
@@ -99,8 +122,22 @@ def __IsBookRead(newEntitlement: dict) -> bool:
     return status == 'Finished'
 
 
-def __GetBookList(kobo: Kobo, listAll: bool, exportFile: Union[TextIO, None]) -> list:
-    bookList = kobo.GetMyBookList()
+def __FetchForEachUser(
+    users: List[User], fetch: Callable[[User], list]
+) -> Generator[Tuple[User, list], None, None]:
+    '''run fetch for every user at the same time, yielding each user's result as soon as it arrives'''
+    if len(users) <= 1:
+        for user in users:
+            yield user, fetch(user)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(users)) as executor:
+        futures = {executor.submit(fetch, user): user for user in users}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
+def __GetBookList(bookList: list, listAll: bool, exportFile: Union[TextIO, None]) -> list:
     rows = []
 
     if exportFile:
@@ -144,12 +181,56 @@ def __GetBookList(kobo: Kobo, listAll: bool, exportFile: Union[TextIO, None]) ->
     return rows
 
 
-def ListBooks(users: List[User], listAll: bool, exportFile: Union[TextIO, None]) -> List[Book]:
-    '''list all books currently in the account'''
-    for user in users:
+def __ExportBookList(
+    user: User, bookList: Generator[dict, None, None], export: LibraryExport, delta: bool
+) -> list:
+    '''write each entitlement to the export as it arrives; delta skips those unchanged since last time'''
+    fingerprintsPath = None
+    if Globals.Settings is not None and len(user.DeviceId) > 0:
+        fingerprintsPath = Globals.Settings.GetCachePath(f'export-{user.DeviceId}.json')
+    fingerprints = ExportFingerprints(fingerprintsPath)
+
+    exported = []
+    for entitlement in bookList:
+        exported.append(entitlement)
+        entitlementId = LibraryStore.GetEntitlementId(entitlement.get('NewEntitlement', {}))
+        changed = entitlementId is None or fingerprints.IsChanged(entitlementId, entitlement)
+        if changed or not delta:
+            export.Write(entitlement, user.Email)
+    if delta:
+        for entitlementId in fingerprints.GetRemoved():
+            export.WriteRemoved(entitlementId, user.Email)
+    # Every export, delta or not, is what the next delta export is compared to.
+    fingerprints.Save()
+    return exported
+
+
+def ListBooks(
+    users: List[User],
+    listAll: bool,
+    exportFile: Union[TextIO, None],
+    fullSync: bool = False,
+    ndjsonExport: Union[LibraryExport, None] = None,
+    exportDelta: bool = False,
+) -> List[Book]:
+    '''
+    list all books currently in the accounts; the accounts are synced at the same time.
+    ndjsonExport is written while the library is being synced; with exportDelta, only what changed
+    since the account's previous export is written to it.
+    '''
+
+    def fetch(user: User) -> list:
         kobo = Kobo(user)
         kobo.LoadInitializationSettings()
-        rows = __GetBookList(kobo, listAll, exportFile)
+        if ndjsonExport is not None:
+            return __ExportBookList(
+                user, kobo.IterMyBookList(fullSync=fullSync), ndjsonExport, exportDelta
+            )
+        return kobo.GetMyBookList(fullSync=fullSync)
+
+    for user, bookList in __FetchForEachUser(users, fetch):
+        # Rows are built here rather than in the workers so exportFile is only written from one thread.
+        rows = __GetBookList(bookList, listAll, exportFile)
         for columns in rows:
             yield Book(
                 RevisionId=columns[0],
@@ -162,11 +243,15 @@ def ListBooks(users: List[User], listAll: bool, exportFile: Union[TextIO, None])
 
 # Wishlist item response example
 # {'DateAdded': '2020-05-12T00:51:32.8860172Z', 'CrossRevisionId': '4dc63ad1-0b4d-3e52-a8bb-704e632963e8', 'IsPurchaseable': True, 'IsSupportedOnCurrentPlatform': True, 'ProductMetadata': {'Book': {'Contributors': 'Mohsin Hamid', 'WorkId': '75952d21-3893-40a6-a6a2-088ae9337c8a', 'Subtitle': 'A Novel', 'IsFree': False, 'ISBN': '9780735212183', 'PublicationDate': '2017-03-07T00:00:00.0000000Z', 'ExternalIds': ['od_2814358'], 'ContributorRoles': [{'Name': 'Mohsin Hamid', 'Role': 'Author'}], 'IsInternetArchive': False, 'IsRecommendation': False, 'CrossRevisionId': '4dc63ad1-0b4d-3e52-a8bb-704e632963e8', 'Title': 'Exit West', 'Description': '<p>**One of <em>The New York Times</em>’s 100 Best Books of the 21st Century</p><p>FINALIST FOR THE BOOKER PRIZE & WINNER OF THE <em>L.A. TIMES</em> BOOK PRIZE FOR FICTION and THE ASPEN WORDS LITERARY PRIZE**</p><p><strong>“It was as if Hamid knew what was going to happen to America and the world, and gave us a road map to our future… At once terrifying and … oddly hopeful.” —Ayelet Waldman, <em>The New York Times Book Review</em></strong></p><p><strong>“Moving, audacious, and indelibly hu...', 'Language': 'en', 'Locale': {'LanguageCode': 'eng', 'ScriptCode': '', 'CountryCode': ''}, 'ImageId': '573021a8-715d-465a-890f-b24207ab06c1', 'PublisherName': 'Penguin Publishing Group', 'Rating': 4.047826, 'TotalRating': 230, 'RatingHistogram': {'1': 5, '2': 10, '3': 41, '4': 87, '5': 0}, 'Slug': 'exit-west', 'IsContentSharingEnabled': True, 'RedirectPreviewUrls': [{'DrmType': 'None', 'Format': 'EPUB3_SAMPLE', 'Url': 'https://storedownloads.kobo.com/download?downloadToken=eyJ0eXAiOjIsInZlciI6bnVsbCwicHR5cCI6IlByZXZpZXdEb3dubG9hZFRva2VuIn0.cWoOja1aXK_bQjhEf72K0w.iEKSnYBwnUrYuNfhuMBUHMoAzbeXVrLetDoYjZ-9X9iWeePtNPb3J8Qwr4677v-BaUC6jb9RuBIVqb5eEb-fvB7ATEVKYUw-eRUVK0PzRtW323wKWN_VVRbyhzhnXmPcwZytK6V3MwI4DRkY7nD6IOdVZaZxfbkutyykmBY2fOYTGMke0UioXu4tYrTM65G6N2cw15UTDg8-7i0_WRlrNRAOCf8R4cRmvblfySKmZWT7V2grysKnMNPginyNX2YSkgCRfLVZgSwxOrtqiBi8ukUNjFJj4OSU6RvOwSPvu_R37cDnEW8Vft6tilrgc10nhXRKgUllGP8kN9DJXX6UbvhOKlrKCKzHJnkn4G272PQLFymSPSS_2frfbszEq_DuPiB-vNZgsgfP0B9ylHMx_oN497GSYfp8Kg9fiv8A9KZBz3DAU6r6Lgji5U5U0Dr0y4WBQ8hz2dVzKDTffwKkXDJFpbmd495Bb57BUf0JtsWt19n0aRALYJcjEQ3zKREpgKqLcHX4SpmBqrv1PkPr8tNwi-CINd1JXyll9SwSjmhfmHVcq7Lykgz4WCQ1oGwjGup3nEzHwpFwPq3RITFCZkUy41mc0QqZZ83PpWA3dqSNK-nsp5uZ84gw024C0CuUUq0GmefN3YD73fxBT2ASrA', 'Platform': 'Generic', 'Size': 742692}], 'HasPreview': True, 'Price': {'Currency': 'USD', 'Price': 13.99}, 'PromoCodeAllowed': False, 'EligibleForKoboLoveDiscount': False, 'IsPreOrder': False, 'RelatedGroupId': '180cc678-2429-c8da-0000-000000000000', 'AgeVerificationRequired': False, 'AccessibilityDetails': {'IsFixedLayout': False, 'IsTextToSpeechAllowed': False}, 'Id': 'ba03ec06-e024-46bb-b7fb-56b20c04f598'}}}
-def GetWishList(users: List[User]) -> List[Book]:
-    for user in users:
+def GetWishList(users: List[User], pageSize: int = 100, jobs: int = 4) -> List[Book]:
+    '''list the wishlists; each one is fetched `pageSize` items per page, `jobs` pages at a time'''
+
+    def fetch(user: User) -> list:
         kobo = Kobo(user)
         kobo.LoadInitializationSettings()
-        wishList = kobo.GetMyWishList()
+        return kobo.GetMyWishList(pageSize=pageSize, jobs=jobs)
+
+    for user, wishList in __FetchForEachUser(users, fetch):
         for item in wishList:
             yield Book(
                 RevisionId=item['CrossRevisionId'],
@@ -207,89 +292,415 @@ def CheckActivation(user: User, check_url: str) -> bool:
         return False
 
 
+def __ReportFailedDownload(productId: str, e: Exception) -> None:
+    Metrics.Increment('books_downloaded_total', result='failed')
+    click.echo(
+        (
+            f'Skipping failed download for {productId}: {str(e)}'
+            '\n  -- Try downloading it as a single book to get the complete exception details'
+            ' and open an issue on the project GitHub page: https://github.com/subdavis/kobo-book-downloader/issues'
+        ),
+        err=True,
+    )
+
+
+def __OpenDownloadCatalog() -> DownloadCatalog:
+    if Globals.Settings is None:
+        return DownloadCatalog()
+    try:
+        return DownloadCatalog(Globals.Settings.GetCachePath('catalog.sqlite'))
+    except (OSError, sqlite3.Error) as err:
+        # Without a usable catalog we still have the file name based skip check.
+        debug_data('Could not open the download catalog', err)
+        return DownloadCatalog()
+
+
+def __GetCatalogOwner(user: User) -> str:
+    return user.UserId or user.Email
+
+
+def __RecordDownload(catalog: DownloadCatalog, user: User, info: DownloadInfo) -> None:
+    drm = info.HasDrm[0] if info.HasDrm else 'None'
+    # Books with Adobe DRM are saved next to the intended path as an encrypted .ade file.
+    for path in [info.OutputPath, info.OutputPath + '.ade']:
+        if os.path.exists(path):
+            entry = catalog.Record(
+                Kobo.GetProductId(info.BookMetadata), path, __GetCatalogOwner(user), drm
+            )
+            __ShareDuplicate(catalog, entry)
+            return
+
+
+def __ShareDuplicate(catalog: DownloadCatalog, entry: CatalogEntry) -> None:
+    # Once the DRM is removed, every account's copy of a book is the same file, so one copy on disk
+    # can serve all of them.
+    duplicate = catalog.FindDuplicate(entry)
+    if duplicate is None:
+        return
+    try:
+        method = DownloadCatalog.LinkFile(duplicate.Path, entry.Path)
+    except OSError as err:
+        debug_data('Could not link duplicate download', entry.Path, err)
+        return
+    click.echo(f'{entry.Path} is identical to {duplicate.Path}, sharing it ({method})')
+
+
+def __LinkVerifiedCopy(
+    catalog: DownloadCatalog, user: User, bookMetadata: dict, outputFilePath: str
+) -> bool:
+    '''use a copy of the book another account (or another output directory) already has'''
+    revisionId = Kobo.GetProductId(bookMetadata)
+    copy = catalog.FindVerifiedCopy(revisionId)
+    if copy is None:
+        return False
+    if copy.Path != os.path.abspath(outputFilePath):
+        try:
+            os.makedirs(os.path.dirname(outputFilePath), exist_ok=True)
+            method = DownloadCatalog.LinkFile(copy.Path, outputFilePath)
+        except OSError as err:
+            debug_data('Could not link verified copy, downloading instead', copy.Path, err)
+            return False
+        click.echo(f'Using the copy of {revisionId} at {copy.Path} for {outputFilePath} ({method})')
+    catalog.Record(revisionId, outputFilePath, __GetCatalogOwner(user), copy.Drm, copy.Sha256)
+    return True
+
+
+def __DownloadBook(
+    kobo: Kobo,
+    bookMetadata: dict,
+    book_type: BookType,
+    outputFilePath: str,
+    raiseErrors: bool = False,
+    audiobookJobs: int = 4,
+    decryptWorkers: int = 1,
+    catalog: Union[DownloadCatalog, None] = None,
+    failures: Union[List[Tuple[str, Exception]], None] = None,
+) -> None:
+    currentProductId = Kobo.GetProductId(bookMetadata)
+    try:
+        click.echo(f'Downloading {currentProductId} to {outputFilePath}', err=True)
+        os.makedirs(os.path.dirname(outputFilePath), exist_ok=True)
+        info = kobo.Download(
+            bookMetadata,
+            book_type == BookType.AUDIOBOOK,
+            outputFilePath,
+            audiobookJobs=audiobookJobs,
+            decryptWorkers=decryptWorkers,
+        )
+        Metrics.Increment('books_downloaded_total', result='ok')
+        if catalog is not None:
+            __RecordDownload(catalog, kobo.user, info)
+    except Exception as e:
+        if raiseErrors:
+            Metrics.Increment('books_downloaded_total', result='failed')
+            raise e
+
+        __ReportFailedDownload(currentProductId, e)
+        if failures is not None:
+            failures.append((currentProductId, e))
+
+
+def __StartPipelineStage(
+    work: Callable[[DownloadInfo], DownloadInfo],
+    inputQueue: queue.Queue,
+    outputQueue: Union[queue.Queue, None],
+    workers: int,
+    failures: Union[List[Tuple[str, Exception]], None] = None,
+) -> List[threading.Thread]:
+    '''start `workers` threads that pass each DownloadInfo from inputQueue through `work` until they get None'''
+
+    def run():
+        while True:
+            info = inputQueue.get()
+            if info is None:
+                return
+            try:
+                info = work(info)
+            except Exception as e:
+                __ReportFailedDownload(Kobo.GetProductId(info.BookMetadata), e)
+                if failures is not None:
+                    failures.append((Kobo.GetProductId(info.BookMetadata), e))
+                continue
+            if outputQueue is not None:
+                outputQueue.put(info)
+
+    threads = [threading.Thread(target=run) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def __StopPipelineStage(threads: List[threading.Thread], inputQueue: queue.Queue) -> None:
+    for _ in threads:
+        inputQueue.put(None)
+    for thread in threads:
+        thread.join()
+
+
 def GetBookOrBooks(
     user: User,
     outputPath: str,
     formatStr: str = r'{Author} - {Title} {ShortRevisionId}',
     productId: str = '',
     includePreviews: bool = True,
+    fullSync: bool = False,
+    jobs: int = 1,
+    audiobookJobs: int = 4,
+    decryptWorkers: int = 1,
+    pipeline: bool = False,
+    productIds: Union[List[str], None] = None,
 ) -> Union[None, str]:
     """
-    download 1 or all books to file
+    download 1, several (`productIds`) or all books to file
     returns output filepath if identifier is passed, otherwise returns None
+    when downloading by product id, a failed download raises its exception; when several failed, or
+    some product ids aren't in the library, DownloadFailedException is raised once the others are done
+    when downloading several or all books, up to `jobs` books are downloaded at the same time
+    up to `audiobookJobs` parts of each audiobook are downloaded at the same time
+    DRM removal of each book runs on `decryptWorkers` threads
+    with `pipeline`, resolving download URLs, transferring (`jobs` at a time) and removing DRM run as
+    separate stages, so the next book downloads while the previous one is being decrypted
     """
     outputPath = os.path.abspath(outputPath)
     kobo = Kobo(user)
     kobo.LoadInitializationSettings()
 
-    # Must call GetBookList every time, even if you're only getting 1 book,
+    # Must sync the library every time, even if you're only getting 1 book,
     # because it invokes a library sync endpoint.
     # This is the only known endpoint that returns
     # download URLs along with book metadata.
-    bookList = kobo.GetMyBookList()
+    bookList = kobo.IterMyBookList(fullSync=fullSync)
+    catalog = __OpenDownloadCatalog()
+
+    wantedProductIds = [productId] if productId else productIds or []
+    missingProductIds = []
+    if wantedProductIds:
+        # Every requested book is looked up in the same sync instead of syncing once per book, and the
+        # sync stops as soon as all of them were seen.
+        index = {}
+        for entitlement in bookList:
+            newEntitlement = entitlement.get('NewEntitlement')
+            if newEntitlement is not None:
+                index[__GetEntitlementProductId(newEntitlement)] = newEntitlement
+                if all(wantedProductId in index for wantedProductId in wantedProductIds):
+                    break
+        newEntitlements = []
+        for wantedProductId in dict.fromkeys(wantedProductIds):
+            if wantedProductId in index:
+                newEntitlements.append(index[wantedProductId])
+            else:
+                missingProductIds.append(wantedProductId)
+    else:
+        # Downloads start with the first library_sync page, while the next ones are still loading.
+        newEntitlements = (entitlement.get('NewEntitlement') for entitlement in bookList)
+
+    # (product id, exception) of every failed download, filled from all the worker threads.
+    failedDownloads: List[Tuple[str, Exception]] = []
+    workerState = threading.local()
+
+    def getWorkerKobo() -> Kobo:
+        # Sessions are not safe to share between threads, so every worker gets its own Kobo.
+        if not hasattr(workerState, 'kobo'):
+            workerState.kobo = Kobo(user)
+            # Served from the cache the main thread just filled.
+            workerState.kobo.LoadInitializationSettings()
+        return workerState.kobo
+
+    def downloadInWorker(bookMetadata: dict, book_type: BookType, outputFilePath: str) -> None:
+        __DownloadBook(
+            getWorkerKobo(),
+            bookMetadata,
+            book_type,
+            outputFilePath,
+            audiobookJobs=audiobookJobs,
+            decryptWorkers=decryptWorkers,
+            catalog=catalog,
+            failures=failedDownloads,
+        )
+
+    def prepareStage(info: DownloadInfo) -> DownloadInfo:
+        return getWorkerKobo().PrepareDownload(info.BookMetadata, info.IsAudiobook, info.OutputPath)
+
+    def transferStage(info: DownloadInfo) -> DownloadInfo:
+        click.echo(
+            f'Downloading {Kobo.GetProductId(info.BookMetadata)} to {info.OutputPath}', err=True
+        )
+        os.makedirs(os.path.dirname(info.OutputPath), exist_ok=True)
+        getWorkerKobo().TransferDownload(info, audiobookJobs)
+        return info
+
+    def finishStage(info: DownloadInfo) -> DownloadInfo:
+        getWorkerKobo().FinishDownload(info, decryptWorkers)
+        Metrics.Increment('books_downloaded_total', result='ok')
+        __RecordDownload(catalog, user, info)
+        return info
+
+    executor = None
+    futures = []
+    stages = []
+    # Output paths of the books already scheduled in this run. Workers could otherwise download two
+    # books that get the same file name (e.g. with --format-str '{Title}') into the same file at once.
+    scheduledOutputPaths = set()
+    if not productId and pipeline:
+        # Bounded queues keep each stage at most a few books ahead of the next one. That also stops
+        # download URLs from being resolved long before they are used, as they expire.
+        prepareQueue = queue.Queue(maxsize=jobs)
+        transferQueue = queue.Queue(maxsize=jobs)
+        finishQueue = queue.Queue(maxsize=jobs)
+        stages = [
+            (
+                __StartPipelineStage(prepareStage, prepareQueue, transferQueue, 1, failedDownloads),
+                prepareQueue,
+            ),
+            (
+                __StartPipelineStage(
+                    transferStage, transferQueue, finishQueue, jobs, failedDownloads
+                ),
+                transferQueue,
+            ),
+            (
+                __StartPipelineStage(finishStage, finishQueue, None, 1, failedDownloads),
+                finishQueue,
+            ),
+        ]
+    elif not productId and jobs > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
 
-    for entitlement in bookList:
-        newEntitlement = entitlement.get('NewEntitlement')
-        if newEntitlement is None:
-            continue
+    try:
+        for newEntitlement in newEntitlements:
+            if newEntitlement is None:
+                continue
+
+            if not includePreviews and newEntitlement.get('BookEntitlement') is not None:
+                access = newEntitlement.get('BookEntitlement').get('Accessibility')
+                if access != 'Full':
+                    click.echo(f'Skipping {access} access book')
+                    continue
 
-        if not includePreviews and newEntitlement.get('BookEntitlement') is not None:
-            access =  newEntitlement.get('BookEntitlement').get('Accessibility')
-            if access != 'Full':
-                click.echo(f'Skipping {access} access book')
+            bookMetadata, book_type = __GetBookMetadata(newEntitlement)
+            if book_type is None:
+                click.echo('Skipping book of unknown type')
                 continue
 
-        bookMetadata, book_type = __GetBookMetadata(newEntitlement)
-        if book_type is None:
-            click.echo('Skipping book of unknown type')
-            continue
+            elif book_type == BookType.SUBSCRIPTION:
+                click.echo('Skipping subscribtion entity')
+                continue
 
-        elif book_type == BookType.SUBSCRIPTION:
-            click.echo('Skipping subscribtion entity')
-            continue
+            fileName = __MakeFileNameForBook(bookMetadata, formatStr)
+            if book_type == BookType.EBOOK:
+                # Audiobooks go in sub-directories
+                # but epub files go directly in outputPath
+                fileName += '.epub'
+            outputFilePath = os.path.join(outputPath, fileName)
+            if outputFilePath in scheduledOutputPaths:
+                productIdToSkip = Kobo.GetProductId(bookMetadata)
+                click.echo(f'Skipping {productIdToSkip}, another book is saved to {outputFilePath}')
+                continue
 
-        fileName = __MakeFileNameForBook(bookMetadata, formatStr)
-        if book_type == BookType.EBOOK:
-            # Audiobooks go in sub-directories
-            # but epub files go directly in outputPath
-            fileName += '.epub'
-        outputFilePath = os.path.join(outputPath, fileName)
+            if not wantedProductIds:
+                # when downloading ALL books, skip books we've downloaded before
+                # the catalog knows them by RevisionId, whatever name they were saved under
+                catalogEntry = catalog.Find(
+                    Kobo.GetProductId(bookMetadata), outputPath, __GetCatalogOwner(user)
+                )
+                if catalogEntry is not None:
+                    click.echo(f'Skipping already downloaded book {catalogEntry.Path}')
+                    continue
+                if os.path.exists(outputFilePath):
+                    click.echo(f'Skipping already downloaded book {outputFilePath}')
+                    continue
+
+            # Skip archived books.
+            if __IsBookArchived(newEntitlement):
+                click.echo(f'Skipping archived book {fileName}')
+                continue
 
-        if not productId and os.path.exists(outputFilePath):
-            # when downloading ALL books, skip books we've downloaded before
-            click.echo(f'Skipping already downloaded book {outputFilePath}')
-            continue
+            scheduledOutputPaths.add(outputFilePath)
 
-        currentProductId = Kobo.GetProductId(bookMetadata)
-        if productId and productId != currentProductId:
-            # user only asked for a single title,
-            # and this is not the book they want
-            continue
+            # Audiobooks have no hash in the catalog, so only ebooks are shared between accounts.
+            if book_type == BookType.EBOOK and __LinkVerifiedCopy(
+                catalog, user, bookMetadata, outputFilePath
+            ):
+                if productId:
+                    return outputFilePath
+                continue
 
-        # Skip archived books.
-        if __IsBookArchived(newEntitlement):
-            click.echo(f'Skipping archived book {fileName}')
-            continue
+            if stages:
+                prepareQueue.put(
+                    DownloadInfo(
+                        BookMetadata=bookMetadata,
+                        IsAudiobook=book_type == BookType.AUDIOBOOK,
+                        OutputPath=outputFilePath,
+                    )
+                )
+            elif executor is None:
+                __DownloadBook(
+                    kobo,
+                    bookMetadata,
+                    book_type,
+                    outputFilePath,
+                    # A single book raises right away, with the complete exception details.
+                    raiseErrors=len(wantedProductIds) == 1,
+                    audiobookJobs=audiobookJobs,
+                    decryptWorkers=decryptWorkers,
+                    catalog=catalog,
+                    failures=failedDownloads,
+                )
+            else:
+                futures.append(
+                    executor.submit(downloadInWorker, bookMetadata, book_type, outputFilePath)
+                )
 
-        try:
-            click.echo(f'Downloading {currentProductId} to {outputFilePath}', err=True)
-            os.makedirs(os.path.dirname(outputFilePath), exist_ok=True)
-            kobo.Download(bookMetadata, book_type == BookType.AUDIOBOOK, outputFilePath)
-        except Exception as e:
             if productId:
-                raise e
-
-            click.echo(
-                (
-                    f'Skipping failed download for {currentProductId}: {str(e)}'
-                    '\n  -- Try downloading it as a single book to get the complete exception details'
-                    ' and open an issue on the project GitHub page: https://github.com/subdavis/kobo-book-downloader/issues'
-                ),
-                err=True,
+                # TODO: support audiobook downloads from web
+                return outputFilePath
+    finally:
+        # Also when scheduling fails, so that the books already handed to the workers are finished or
+        # reported instead of being cut off halfway when the interpreter exits.
+        # Each stage is stopped only after the one feeding it, so every queued book makes it through.
+        for threads, inputQueue in stages:
+            __StopPipelineStage(threads, inputQueue)
+
+        if executor is not None:
+            # __DownloadBook reports its own failures, so this only waits for the pool to drain.
+            executor.shutdown()
+
+    if wantedProductIds and (failedDownloads or missingProductIds):
+        if len(failedDownloads) == 1 and not missingProductIds:
+            raise failedDownloads[0][1]
+        messages = [f'{failedProductId}: {e}' for failedProductId, e in failedDownloads]
+        if missingProductIds:
+            messages.append(
+                f'could not find these products in the library: {", ".join(missingProductIds)}'
             )
-
-        if productId:
-            # TODO: support audiobook downloads from web
-            return outputFilePath
+        raise DownloadFailedException('\n'.join(messages))
 
     return None
+
+
+def RebuildCatalog(
+    user: User, outputPath: str, formatStr: str = r'{Author} - {Title} {ShortRevisionId}'
+) -> List[CatalogEntry]:
+    """
+    scan an existing output directory and record the books in it in the download catalog
+    books are recognized by the name formatStr gives them, or by their ShortRevisionId
+    """
+    kobo = Kobo(user)
+    kobo.LoadInitializationSettings()
+    candidates = {}
+    # Kept apart from candidates, so that a word of a title can't be mistaken for a ShortRevisionId.
+    shortRevisionIds = {}
+    for entitlement in kobo.GetMyBookList():
+        newEntitlement = entitlement.get('NewEntitlement')
+        if newEntitlement is None:
+            continue
+        for key in ['BookMetadata', 'AudiobookMetadata']:
+            bookMetadata = newEntitlement.get(key)
+            if bookMetadata is None:
+                continue
+            revisionId = Kobo.GetProductId(bookMetadata)
+            candidates[__MakeFileNameForBook(bookMetadata, formatStr)] = revisionId
+            shortRevisionIds[revisionId[:8]] = revisionId
+    return __OpenDownloadCatalog().Rebuild(
+        outputPath, candidates, shortRevisionIds, __GetCatalogOwner(user)
+    )
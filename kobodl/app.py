@@ -1,14 +1,31 @@
 import os
 
-from flask import Flask, abort, jsonify, redirect, render_template, request, send_from_directory
+from flask import (
+    Flask,
+    Response,
+    abort,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_from_directory,
+)
 
 from kobodl import actions
 from kobodl.globals import Globals
+from kobodl.metrics import Metrics
 from kobodl.settings import User
+from kobodl.transport import RateLimiter, Transport
 
 app = Flask(__name__)
 
 
+@app.before_request
+def reload_settings():
+    # Pick up users and tokens that CLI runs changed while the server was running.
+    Globals.Settings.Reload()
+
+
 @app.route('/')
 def index():
     return redirect('/user')
@@ -98,6 +115,23 @@ def downloadBook(userid, productid):
     return send_from_directory(absOutputDir, tail, as_attachment=True, download_name=tail)
 
 
+@app.route('/limit-rate', methods=['GET', 'POST'])
+def limitRate():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        try:
+            # 0 removes the limit.
+            Transport.RateLimiter.SetRate(RateLimiter.ParseRate(str(data.get('limit_rate', ''))))
+        except ValueError:
+            return jsonify({'error': 'limit_rate must be a rate like 500k or 2M, or 0'}), 400
+    return jsonify({'limit_rate': Transport.RateLimiter.BytesPerSecond})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(Metrics.FormatPrometheus(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/book', methods=['GET'])
 def books():
     userlist = Globals.Settings.UserList.users
@@ -0,0 +1,283 @@
+import dataclasses
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Union
+
+from kobodl.debug import debug_data
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, which has no reflinks we could use anyway.
+    fcntl = None
+
+
+@dataclasses.dataclass
+class CatalogEntry:
+    RevisionId: str
+    Path: str
+    Owner: str
+    Size: int
+    Sha256: str
+    DownloadedAt: float
+    Drm: str
+
+
+class DownloadCatalog:
+    '''
+    SQLite index of downloaded books, keyed by RevisionId.
+
+    Skip decisions are made from here instead of from output file names, so changing --format-str or a
+    change in a book's title or author doesn't cause the book to be downloaded again.
+    Paths are stored absolute; a RevisionId can have several entries, one per output directory.
+    '''
+
+    HashChunkSize = 1024 * 1024
+
+    # FICLONE from linux/fs.h: makes a file share another file's data blocks (btrfs, XFS...).
+    FicloneIoctl = 0x40049409
+
+    def __init__(self, path: str = ':memory:'):
+        self.Path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Download workers share one connection, so every use of it goes through the lock.
+        self.Lock = threading.Lock()
+        self.Connection = sqlite3.connect(path, check_same_thread=False)
+        with self.Lock, self.Connection:
+            self.Connection.execute('''
+                CREATE TABLE IF NOT EXISTS downloads (
+                    path TEXT PRIMARY KEY,
+                    revision_id TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    downloaded_at REAL NOT NULL,
+                    drm TEXT NOT NULL
+                )
+                ''')
+            self.Connection.execute(
+                'CREATE INDEX IF NOT EXISTS downloads_revision_id ON downloads (revision_id)'
+            )
+            self.Connection.execute(
+                'CREATE INDEX IF NOT EXISTS downloads_sha256 ON downloads (sha256)'
+            )
+
+    @staticmethod
+    def GetSize(path: str) -> int:
+        '''size of a book file, or the total size of an audiobook directory'''
+        if os.path.isdir(path):
+            return sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(path)
+                for name in names
+            )
+        return os.path.getsize(path)
+
+    @staticmethod
+    def GetSha256(path: str) -> str:
+        # Audiobook directories are not hashed; their parts are only ever compared by size.
+        if os.path.isdir(path):
+            return ''
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DownloadCatalog.HashChunkSize), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def LinkFile(source: str, destination: str) -> str:
+        '''
+        make destination a copy of source that shares its storage where the filesystem allows it
+        returns how the copy was made: reflink, hardlink or copy
+        '''
+        # Reflinks come first because, unlike hardlinks, they leave the two files independent.
+        temporaryPath = destination + '.linking'
+        try:
+            for method, makeCopy in [
+                ('reflink', DownloadCatalog.__Reflink),
+                ('hardlink', os.link),
+                ('copy', shutil.copy2),
+            ]:
+                if os.path.lexists(temporaryPath):
+                    os.remove(temporaryPath)
+                try:
+                    makeCopy(source, temporaryPath)
+                    break
+                except OSError as err:
+                    if method == 'copy':
+                        raise
+                    debug_data(f'DownloadCatalog: {method} failed', source, err)
+            os.replace(temporaryPath, destination)
+        finally:
+            if os.path.lexists(temporaryPath):
+                os.remove(temporaryPath)
+        return method
+
+    @staticmethod
+    def __Reflink(source: str, destination: str) -> None:
+        if fcntl is None:
+            raise OSError('reflinks are not supported on this platform')
+        with open(source, 'rb') as sourceFile, open(destination, 'wb') as destinationFile:
+            fcntl.ioctl(destinationFile.fileno(), DownloadCatalog.FicloneIoctl, sourceFile.fileno())
+
+    @staticmethod
+    def IsVerified(entry: CatalogEntry) -> bool:
+        '''whether the entry's file is still there with the content it was recorded with'''
+        if not entry.Sha256 or not os.path.isfile(entry.Path):
+            return False
+        if os.path.getsize(entry.Path) != entry.Size:
+            return False
+        return DownloadCatalog.GetSha256(entry.Path) == entry.Sha256
+
+    @staticmethod
+    def IsShareable(entry: CatalogEntry) -> bool:
+        '''whether the file can stand in for another account's copy of the book'''
+        # Adobe DRM is left on the file, and that is tied to the account that downloaded it.
+        return entry.Drm != 'AdobeDrm' and not entry.Path.endswith('.ade')
+
+    def __Select(self, where: str, parameters: tuple) -> List[CatalogEntry]:
+        with self.Lock:
+            rows = self.Connection.execute(
+                '''
+                SELECT revision_id, path, owner, size, sha256, downloaded_at, drm
+                FROM downloads WHERE ''' + where,
+                parameters,
+            ).fetchall()
+        return [CatalogEntry(*row) for row in rows]
+
+    def GetEntries(self, revisionId: str) -> List[CatalogEntry]:
+        return self.__Select('revision_id = ?', (revisionId,))
+
+    def FindVerifiedCopy(self, revisionId: str) -> Union[CatalogEntry, None]:
+        '''a DRM-free copy of this book downloaded by any account, whose content is unchanged'''
+        for entry in self.GetEntries(revisionId):
+            if DownloadCatalog.IsShareable(entry) and DownloadCatalog.IsVerified(entry):
+                return entry
+        return None
+
+    def FindDuplicate(self, entry: CatalogEntry) -> Union[CatalogEntry, None]:
+        '''another file with exactly the same content as entry's'''
+        if not entry.Sha256 or not DownloadCatalog.IsShareable(entry):
+            return None
+        for other in self.__Select('sha256 = ? AND path != ?', (entry.Sha256, entry.Path)):
+            if DownloadCatalog.IsShareable(other) and DownloadCatalog.IsVerified(other):
+                return other
+        return None
+
+    def Find(self, revisionId: str, outputDir: str, owner: str) -> Union[CatalogEntry, None]:
+        '''
+        the entry for this book in outputDir, if its file is still there with the recorded size
+        another owner's entry only counts when its file can stand in for this owner's copy
+        '''
+        outputDir = os.path.join(os.path.abspath(outputDir), '')
+        for entry in self.GetEntries(revisionId):
+            if not entry.Path.startswith(outputDir):
+                continue
+            if entry.Owner != owner and not DownloadCatalog.IsShareable(entry):
+                continue
+            if os.path.exists(entry.Path) and DownloadCatalog.GetSize(entry.Path) == entry.Size:
+                return entry
+            debug_data('DownloadCatalog: forgetting missing or changed file', entry.Path)
+            self.Remove(entry.Path)
+        return None
+
+    def Record(
+        self, revisionId: str, path: str, owner: str, drm: str, sha256: Union[str, None] = None
+    ) -> CatalogEntry:
+        '''sha256 can be passed when the content is already known, e.g. for a link to a verified copy'''
+        path = os.path.abspath(path)
+        entry = CatalogEntry(
+            RevisionId=revisionId,
+            Path=path,
+            Owner=owner,
+            Size=DownloadCatalog.GetSize(path),
+            Sha256=DownloadCatalog.GetSha256(path) if sha256 is None else sha256,
+            DownloadedAt=time.time(),
+            Drm=drm,
+        )
+        with self.Lock, self.Connection:
+            self.Connection.execute(
+                '''
+                INSERT OR REPLACE INTO downloads
+                    (path, revision_id, owner, size, sha256, downloaded_at, drm)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''',
+                (
+                    entry.Path,
+                    entry.RevisionId,
+                    entry.Owner,
+                    entry.Size,
+                    entry.Sha256,
+                    entry.DownloadedAt,
+                    entry.Drm,
+                ),
+            )
+        return entry
+
+    def Remove(self, path: str) -> None:
+        with self.Lock, self.Connection:
+            self.Connection.execute(
+                'DELETE FROM downloads WHERE path = ?', (os.path.abspath(path),)
+            )
+
+    def Rebuild(
+        self,
+        outputDir: str,
+        candidates: Dict[str, str],
+        shortRevisionIds: Dict[str, str],
+        owner: str,
+    ) -> List[CatalogEntry]:
+        '''
+        scan an existing output directory and record the books found in it
+        candidates maps paths relative to outputDir, as the current format string would name them, to
+        RevisionIds; shortRevisionIds maps the first 8 characters of each RevisionId to the RevisionId
+        '''
+        outputDir = os.path.abspath(outputDir)
+        prefix = os.path.join(outputDir, '')
+        with self.Lock, self.Connection:
+            # Not LIKE, which treats _ and % in the path as wildcards and ignores case.
+            self.Connection.execute(
+                'DELETE FROM downloads WHERE substr(path, 1, length(?)) = ?', (prefix, prefix)
+            )
+
+        found = []
+        for root, dirNames, fileNames in os.walk(outputDir):
+            for name in list(dirNames) + fileNames:
+                path = os.path.join(root, name)
+                if name.endswith('.downloading') or name.endswith('.linking'):
+                    continue
+                # Books with Adobe DRM are saved as "<name>.epub.ade".
+                isAdobe = name.endswith('.ade')
+                baseName = name[: -len('.ade')] if isAdobe else name
+                relativePath = os.path.relpath(os.path.join(root, baseName), outputDir)
+                # Audiobook directories have no extension, and dots in their names (e.g. "J. R. R.
+                # Tolkien") are part of the author or title.
+                isDirectory = name in dirNames
+                if not isDirectory:
+                    relativePath = os.path.splitext(relativePath)[0]
+                revisionId = candidates.get(relativePath)
+                if revisionId is None:
+                    revisionId = DownloadCatalog.__FindShortRevisionId(
+                        os.path.basename(relativePath), shortRevisionIds
+                    )
+                if revisionId is None:
+                    continue
+                if isDirectory:
+                    # Audiobook directory; its parts don't need to be looked at one by one.
+                    dirNames.remove(name)
+                drm = 'AdobeDrm' if isAdobe else 'Unknown'
+                found.append(self.Record(revisionId, path, owner, drm))
+        return found
+
+    @staticmethod
+    def __FindShortRevisionId(name: str, shortRevisionIds: Dict[str, str]) -> Union[str, None]:
+        '''name is without its extension'''
+        for word in name.split():
+            if word in shortRevisionIds:
+                return shortRevisionIds[word]
+        return None
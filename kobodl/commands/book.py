@@ -1,12 +1,14 @@
+import contextlib
 import os
 from pathlib import Path
 from typing import List
 
 import click
-from tabulate import tabulate
 
-from kobodl import actions, cli
+from kobodl import actions
 from kobodl.globals import Globals
+from kobodl.kobo import DownloadFailedException
+from kobodl.library import LibraryExport
 
 
 def decorators(book):
@@ -18,6 +20,26 @@ def decorators(book):
     return append
 
 
+def select_user(user):
+    if len(Globals.Settings.UserList.users) == 0:
+        click.echo('error: no users found.  Did you `kobodl user add`?', err=True)
+        exit(1)
+
+    if not user:
+        if len(Globals.Settings.UserList.users) > 1:
+            click.echo('error: must provide --user option when more than 1 user exists.')
+            exit(1)
+        # Exactly 1 user account exists
+        return Globals.Settings.UserList.users[0]
+
+    # A user was passed
+    usercls = Globals.Settings.UserList.getUser(user)
+    if not usercls:
+        click.echo(f'error: could not find user with name or id {user}')
+        exit(1)
+    return usercls
+
+
 @click.group(name='book', short_help='list and download books')
 def book():
     pass
@@ -51,25 +73,55 @@ def book():
         "Default: '{Author} - {Title} {ShortRevisionId}'"
     ),
 )
+@click.option(
+    '--full-sync',
+    is_flag=True,
+    help='ignore the locally stored library and fetch the whole library from Kobo again',
+)
+@click.option(
+    '-j',
+    '--jobs',
+    type=click.IntRange(min=1),
+    default=1,
+    help='number of books to download at the same time. default: 1',
+)
+@click.option(
+    '--audiobook-jobs',
+    type=click.IntRange(min=1),
+    default=4,
+    help='number of audiobook parts to download at the same time. default: 4',
+)
+@click.option(
+    '--decrypt-workers',
+    type=click.IntRange(min=1),
+    default=1,
+    help='number of threads used to remove the DRM of each book. default: 1',
+)
+@click.option(
+    '--pipeline',
+    is_flag=True,
+    help=(
+        'when downloading several books, download the next ones while the previous ones '
+        'are being decrypted. --jobs sets the number of concurrent transfers'
+    ),
+)
 @click.argument('product-id', nargs=-1, type=click.STRING)
 @click.pass_obj
-def get(ctx, user, output_dir: Path, get_all: bool, include_previews: bool, format_str: str, product_id: List[str]):
-    if len(Globals.Settings.UserList.users) == 0:
-        click.echo('error: no users found.  Did you `kobodl user add`?', err=True)
-        exit(1)
-
-    if not user:
-        if len(Globals.Settings.UserList.users) > 1:
-            click.echo('error: must provide --user option when more than 1 user exists.')
-            exit(1)
-        # Exactly 1 user account exists
-        usercls = Globals.Settings.UserList.users[0]
-    else:
-        # A user was passed
-        usercls = Globals.Settings.UserList.getUser(user)
-        if not usercls:
-            click.echo(f'error: could not find user with name or id {user}')
-            exit(1)
+def get(
+    ctx,
+    user,
+    output_dir: Path,
+    get_all: bool,
+    include_previews: bool,
+    format_str: str,
+    full_sync: bool,
+    jobs: int,
+    audiobook_jobs: int,
+    decrypt_workers: int,
+    pipeline: bool,
+    product_id: List[str],
+):
+    usercls = select_user(user)
 
     if get_all and len(product_id):
         click.echo(
@@ -83,10 +135,65 @@ def get(ctx, user, output_dir: Path, get_all: bool, include_previews: bool, form
 
     os.makedirs(output_dir, exist_ok=True)
     if get_all:
-        actions.GetBookOrBooks(usercls, output_dir, formatStr=format_str, includePreviews=include_previews)
+        actions.GetBookOrBooks(
+            usercls,
+            output_dir,
+            formatStr=format_str,
+            includePreviews=include_previews,
+            fullSync=full_sync,
+            jobs=jobs,
+            audiobookJobs=audiobook_jobs,
+            decryptWorkers=decrypt_workers,
+            pipeline=pipeline,
+        )
     else:
-        for pid in product_id:
-            actions.GetBookOrBooks(usercls, output_dir, formatStr=format_str, productId=pid)
+        try:
+            actions.GetBookOrBooks(
+                usercls,
+                output_dir,
+                formatStr=format_str,
+                productIds=product_id,
+                fullSync=full_sync,
+                jobs=jobs,
+                audiobookJobs=audiobook_jobs,
+                decryptWorkers=decrypt_workers,
+                pipeline=pipeline,
+            )
+        except DownloadFailedException as e:
+            click.echo(f'error: {e}', err=True)
+            exit(1)
+
+
+@book.command(name='reindex', short_help='rebuild the download catalog from an output directory')
+@click.option(
+    '-u',
+    '--user',
+    type=click.STRING,
+    help='Required when multiple accounts exist. Use either Email or UserKey',
+)
+@click.option(
+    '-o',
+    '--output-dir',
+    type=click.Path(file_okay=False, dir_okay=True, exists=True),
+    default='kobo_downloads',
+    help='default: kobo_downloads',
+)
+@click.option(
+    '-f',
+    '--format-str',
+    type=click.STRING,
+    default=r'{Author} - {Title} {ShortRevisionId}',
+    help=(
+        "Format string the books were downloaded with. "
+        "Books are also recognized by the {ShortRevisionId} in their name. "
+        "Default: '{Author} - {Title} {ShortRevisionId}'"
+    ),
+)
+@click.pass_obj
+def reindex(ctx, user, output_dir: Path, format_str: str):
+    usercls = select_user(user)
+    entries = actions.RebuildCatalog(usercls, output_dir, formatStr=format_str)
+    click.echo(f'Found {len(entries)} downloaded books in {output_dir}')
 
 
 @book.command(name='list', help='list books')
@@ -103,24 +210,59 @@ def get(ctx, user, output_dir: Path, get_all: bool, include_previews: bool, form
     type=click.File(mode='w'),
     help='filepath to write raw JSON library data to.',
 )
+@click.option(
+    '--export-ndjson',
+    type=click.Path(file_okay=True, dir_okay=False, writable=True),
+    help=(
+        'filepath to write raw library data to while it is synced, one JSON entitlement per line. '
+        'Paths ending in .gz are gzip compressed'
+    ),
+)
+@click.option(
+    '--delta',
+    is_flag=True,
+    help='with --export-ndjson, only write what changed since the previous export',
+)
+@click.option(
+    '--full-sync',
+    is_flag=True,
+    help='ignore the locally stored library and fetch the whole library from Kobo again',
+)
 @click.pass_obj
-def list(ctx, user, read, export_library):
+def list(ctx, user, read, export_library, export_ndjson, delta, full_sync):
+    from tabulate import tabulate
+
+    if delta and not export_ndjson:
+        click.echo('error: --delta can only be used with --export-ndjson', err=True)
+        exit(1)
+
     userlist = Globals.Settings.UserList.users
     if user:
         userlist = [Globals.Settings.UserList.getUser(user)]
-    books = actions.ListBooks(userlist, read, export_library)
     headers = ['Title', 'Author', 'RevisionId', 'Owner']
-    data = sorted(
-        [
-            (
-                book.Title + decorators(book),
-                book.Author,
-                book.RevisionId,
-                book.Owner.Email,
-            )
-            for book in books
-        ]
-    )
+    with contextlib.ExitStack() as stack:
+        ndjsonExport = None
+        if export_ndjson:
+            ndjsonExport = stack.enter_context(LibraryExport(export_ndjson))
+        books = actions.ListBooks(
+            userlist,
+            read,
+            export_library,
+            fullSync=full_sync,
+            ndjsonExport=ndjsonExport,
+            exportDelta=delta,
+        )
+        data = sorted(
+            [
+                (
+                    book.Title + decorators(book),
+                    book.Author,
+                    book.RevisionId,
+                    book.Owner.Email,
+                )
+                for book in books
+            ]
+        )
     click.echo(tabulate(data, headers, tablefmt=ctx['fmt']))
 
 
@@ -132,14 +274,27 @@ def list(ctx, user, read, export_library):
     required=False,
     help='Limit list to a single user. Use either Email or UserKey',
 )
+@click.option(
+    '--page-size',
+    type=click.IntRange(min=1),
+    default=100,
+    help='number of wishlist items to fetch per request. default: 100',
+)
+@click.option(
+    '-j',
+    '--jobs',
+    type=click.IntRange(min=1),
+    default=4,
+    help='number of wishlist pages to fetch at the same time. default: 4',
+)
 @click.pass_obj
-def wishlist(ctx, user):
-    userlist = Globals.Settings.UserList.users
-    
+def wishlist(ctx, user, page_size, jobs):
+    from tabulate import tabulate
+
     userlist = Globals.Settings.UserList.users
     if user:
         userlist = [Globals.Settings.UserList.getUser(user)]
-    books = actions.GetWishList(userlist)
+    books = actions.GetWishList(userlist, pageSize=page_size, jobs=jobs)
     headers = ['Title', 'Author', 'RevisionId', 'Owner', 'Price']
     data = sorted(
         [
@@ -154,5 +309,3 @@ def wishlist(ctx, user):
         ]
     )
     click.echo(tabulate(data, headers, tablefmt=ctx['fmt']))
-
-cli.add_command(book)
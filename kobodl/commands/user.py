@@ -1,9 +1,6 @@
 import click
-from tabulate import tabulate
 
-from kobodl import actions, cli
 from kobodl.globals import Globals
-from kobodl.kobo import Kobo
 from kobodl.settings import User
 
 
@@ -15,6 +12,8 @@ def user():
 @user.command(name='list', help='list all users')
 @click.pass_obj
 def list(ctx):
+    from tabulate import tabulate
+
     userlist = Globals.Settings.UserList.users
     headers = ['Email', 'UserKey', 'DeviceId']
     data = sorted(
@@ -45,11 +44,12 @@ def list(ctx, identifier):
 @user.command(name='add', help='add new user')
 @click.pass_obj
 def add(ctx):
+    # Logging in is the only user command that talks to Kobo, and the only one that needs requests.
+    from kobodl import actions
+
     user = User()
     actions.Login(user)
     Globals.Settings.UserList.users.append(user)
     Globals.Settings.Save()
     click.echo('Login Success. Try to list your books with `kobodl book list`')
 
-
-cli.add_command(user)
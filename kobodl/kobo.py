@@ -1,4 +1,5 @@
 import base64
+import concurrent.futures
 import dataclasses
 import html
 import os
@@ -7,22 +8,22 @@ import secrets
 import string
 import json
 import sys
+import threading
 import time
 import urllib
 from enum import Enum
-from shutil import copyfile
-from typing import Dict, Tuple, Union, Optional
+from typing import Callable, Dict, Generator, Optional, Tuple, Union
 
 import requests
-from dataclasses_json import dataclass_json
 
 from kobodl.debug import debug_data
 from kobodl.globals import Globals
-from kobodl.koboDrmRemover import KoboDrmRemover
+from kobodl.library import LibraryStore, WriteJsonFile
+from kobodl.metrics import Metrics
 from kobodl.settings import User
+from kobodl.transport import KoboSession, Transport
 
 
-@dataclass_json
 @dataclasses.dataclass
 class Book:
     RevisionId: str
@@ -34,6 +35,15 @@ class Book:
     Price: Optional[str] = None
 
 
+@dataclasses.dataclass
+class DownloadInfo:
+    BookMetadata: dict
+    IsAudiobook: bool
+    OutputPath: str
+    Url: str = ""
+    HasDrm: list = dataclasses.field(default_factory=list)
+
+
 class BookType(Enum):
     EBOOK = 1
     AUDIOBOOK = 2
@@ -48,6 +58,11 @@ class KoboException(Exception):
     pass
 
 
+# Raised after downloading several books by product id when some of them failed or weren't found.
+class DownloadFailedException(KoboException):
+    pass
+
+
 class Kobo:
     Affiliate = "Kobo"
     ApplicationVersion = "4.38.23171"
@@ -58,22 +73,95 @@ class Kobo:
     DeviceOsVersion = "NA"
     # Use the user agent of the Kobo e-readers
     UserAgent = "Mozilla/5.0 (Linux; U; Android 2.0; en-us;) AppleWebKit/538.1 (KHTML, like Gecko) Version/4.0 Mobile Safari/538.1 (Kobo Touch 0373/4.38.23171)"
+    # Base URL of the store API; the benchmarks point it at a local stand-in.
+    StoreApiUrl = "https://storeapi.kobo.com"
+    # How long the initialization settings are cached on disk, in seconds.
+    InitializationSettingsTtl = 24 * 60 * 60
+    # Access tokens are refreshed this many seconds before they expire.
+    AccessTokenRefreshMargin = 5 * 60
+    # How long a content_access_book response is reused, in seconds. Its download URLs expire, so keep it short.
+    ContentAccessBookTtl = 5 * 60
+
+    # One lock per user (keyed by DeviceId), shared by every Kobo instance of that user, so that only one
+    # thread at a time refreshes the tokens.
+    __RefreshLocks: Dict[str, threading.Lock] = {}
+    __RefreshLocksLock = threading.Lock()
+
+    # content_access_book responses by (DeviceId, ProductId, DisplayProfile) along with when they were fetched.
+    # Shared by every Kobo instance, because a pipelined download resolves the URL and gets the content keys
+    # on different threads, each with its own instance.
+    __ContentAccessBooks: Dict[Tuple[str, str, str], Tuple[float, dict]] = {}
+    __ContentAccessBooksLock = threading.Lock()
 
     def __init__(self, user: User):
         self.InitializationSettings = {}
-        self.Session = requests.session()
-        self.Session.headers.update({"User-Agent": Kobo.UserAgent})
+        self.InitializationSettingsFromCache = False
+        self.__Sessions = threading.local()
         self.user = user
 
+    # Sessions are not safe to share between threads, and audiobook parts and wishlist pages are fetched on
+    # pool threads, so every thread gets its own session. They still share Transport's per-host limits.
+    @property
+    def Session(self) -> KoboSession:
+        session = getattr(self.__Sessions, "session", None)
+        if session is None:
+            session = KoboSession()
+            session.headers.update({"User-Agent": Kobo.UserAgent})
+            self.__Sessions.session = session
+        return session
+
     # PRIVATE METHODS
 
     # This could be added to the session but then we would need to add { "Authorization": None } headers to all other
     # functions that doesn't need authorization.
     def __GetHeaderWithAccessToken(self) -> dict:
+        self.__RefreshExpiringAccessToken()
         authorization = "Bearer " + self.user.AccessToken
         headers = {"Authorization": authorization}
         return headers
 
+    @staticmethod
+    def __GetAccessTokenExpiry(accessToken: str) -> Union[float, None]:
+        # Access tokens are JWTs; the payload's "exp" claim is when the token stops being accepted. The
+        # signature is not checked, the server does that. Anything that can't be decoded means "unknown"
+        # and is left for the reauthentication hook to deal with.
+        parts = accessToken.split(".")
+        if len(parts) != 3:
+            return None
+        try:
+            payload = base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4))
+            expiry = json.loads(payload).get("exp")
+        except (ValueError, AttributeError):
+            return None
+        if not isinstance(expiry, (int, float)):
+            return None
+        return float(expiry)
+
+    def __GetRefreshLock(self) -> threading.Lock:
+        with Kobo.__RefreshLocksLock:
+            return Kobo.__RefreshLocks.setdefault(self.user.DeviceId, threading.Lock())
+
+    def __RefreshExpiringAccessToken(self) -> None:
+        if not self.user.AreAuthenticationSettingsSet():
+            return
+        expiry = Kobo.__GetAccessTokenExpiry(self.user.AccessToken)
+        if expiry is None or expiry - time.time() > Kobo.AccessTokenRefreshMargin:
+            return
+        debug_data("Access token expires soon, refreshing it", expiry)
+        self.__RefreshAuthenticationOnce(self.user.AccessToken, "expiring")
+
+    # Refreshes the tokens unless another thread already did while we waited for the lock. staleAccessToken
+    # is the token the caller found to be expired (or about to be); if the user's token is no longer that
+    # one, the refresh already happened and the caller can simply use the new token.
+    def __RefreshAuthenticationOnce(self, staleAccessToken: str, reason: str) -> None:
+        with self.__GetRefreshLock():
+            # Another kobodl process sharing the settings file may have refreshed the tokens already.
+            Globals.Settings.Reload()
+            if self.user.AccessToken != staleAccessToken:
+                return
+            Metrics.Increment("token_refreshes_total", reason=reason)
+            self.__RefreshAuthentication()
+
     def __CheckActivation(self, activationCheckUrl) -> Union[Tuple[str, str, str], None]:
         response = self.Session.post(activationCheckUrl)
         response.raise_for_status()
@@ -138,8 +226,11 @@ class Kobo:
 
         return activationCheckUrl, activationCode
 
+    # Use __RefreshAuthenticationOnce instead; every refresh invalidates the previous RefreshToken, so two at
+    # the same time would leave one of them with tokens that no longer work.
     def __RefreshAuthentication(self) -> None:
-        headers = self.__GetHeaderWithAccessToken()
+        # Not __GetHeaderWithAccessToken, that could start another refresh.
+        headers = {"Authorization": "Bearer " + self.user.AccessToken}
 
         postData = {
             "AppVersion": Kobo.ApplicationVersion,
@@ -150,7 +241,7 @@ class Kobo:
 
         # The reauthentication hook is intentionally not set.
         response = self.Session.post(
-            "https://storeapi.kobo.com/v1/auth/refresh", json=postData, headers=headers
+            f"{Kobo.StoreApiUrl}/v1/auth/refresh", json=postData, headers=headers
         )
         debug_data("RefreshAuth", postData, response.text)
         response.raise_for_status()
@@ -186,10 +277,10 @@ class Kobo:
 
             prep = r.request.copy()
 
-            # Refresh the authentication token and use it.
-            self.__RefreshAuthentication()
-            headers = self.__GetHeaderWithAccessToken()
-            prep.headers["Authorization"] = headers["Authorization"]
+            # Refresh the authentication token, unless a concurrent request already did, and use it.
+            staleAccessToken = prep.headers.get("Authorization", "")[len("Bearer ") :]
+            self.__RefreshAuthenticationOnce(staleAccessToken, "unauthorized")
+            prep.headers["Authorization"] = "Bearer " + self.user.AccessToken
 
             # Don't retry to reauthenticate this request again.
             prep.deregister_hook("response", ReauthenticationHook)
@@ -202,8 +293,33 @@ class Kobo:
 
         return {"response": ReauthenticationHook}
 
-    def __GetMyBookListPage(self, syncToken: str) -> Tuple[list, str]:
-        url = self.InitializationSettings["library_sync"]
+    # The endpoint URLs come from LoadInitializationSettings, which may have served them from its cache. When
+    # a cached URL looks gone, the settings are fetched again and sendRequest, which must read its URL from
+    # self.InitializationSettings, is retried once.
+    def __SendEndpointRequest(
+        self, sendRequest: Callable[[], requests.Response]
+    ) -> requests.Response:
+        try:
+            response = sendRequest()
+            response.raise_for_status()
+            return response
+        except (requests.ConnectionError, requests.HTTPError) as err:
+            if not self.InitializationSettingsFromCache:
+                raise
+            if isinstance(err, requests.HTTPError) and err.response.status_code not in [
+                requests.codes.not_found,  # 404
+                requests.codes.method_not_allowed,  # 405
+                requests.codes.gone,  # 410
+            ]:
+                raise
+            debug_data("Cached initialization settings look stale", err)
+            self.LoadInitializationSettings(useCache=False)
+
+        response = sendRequest()
+        response.raise_for_status()
+        return response
+
+    def __GetMyBookListPage(self, syncToken: str) -> Tuple[list, str, bool]:
         headers = self.__GetHeaderWithAccessToken()
         hooks = self.__GetReauthenticationHook()
 
@@ -211,29 +327,63 @@ class Kobo:
             headers["x-kobo-synctoken"] = syncToken
 
         debug_data("GetMyBookListPage")
-        response = self.Session.get(url, headers=headers, hooks=hooks)
-        response.raise_for_status()
+        with Metrics.Time("library_sync_page_seconds"):
+            response = self.__SendEndpointRequest(
+                lambda: self.Session.get(
+                    self.InitializationSettings["library_sync"], headers=headers, hooks=hooks
+                )
+            )
         bookList = response.json()
 
-        syncToken = ""
-        syncResult = response.headers.get("x-kobo-sync")
-        if syncResult == "continue":
-            syncToken = response.headers.get("x-kobo-synctoken", "")
+        # The last token is kept even when the sync is complete: sending it next time only returns the changes.
+        syncToken = response.headers.get("x-kobo-synctoken", syncToken)
+        hasMore = response.headers.get("x-kobo-sync") == "continue"
+
+        return bookList, syncToken, hasMore
 
-        return bookList, syncToken
+    def __GetLibraryStore(self) -> LibraryStore:
+        if Globals.Settings is None or len(self.user.DeviceId) == 0:
+            return LibraryStore(None)
+        return LibraryStore(Globals.Settings.GetCachePath(f"library-{self.user.DeviceId}.json"))
 
+    # The response holds both the download URL and the content keys, so it is cached for a while instead of
+    # being requested once for each.
     def __GetContentAccessBook(self, productId: str, displayProfile: str) -> dict:
-        url = self.InitializationSettings["content_access_book"].replace("{ProductId}", productId)
+        cacheKey = (self.user.DeviceId, productId, displayProfile)
+        with Kobo.__ContentAccessBooksLock:
+            cached = Kobo.__ContentAccessBooks.get(cacheKey)
+        if cached is not None and time.monotonic() - cached[0] < Kobo.ContentAccessBookTtl:
+            debug_data("GetContentAccessBook: using the cached response")
+            return cached[1]
+
         params = {"DisplayProfile": displayProfile}
         headers = self.__GetHeaderWithAccessToken()
         hooks = self.__GetReauthenticationHook()
 
+        def sendRequest():
+            url = self.InitializationSettings["content_access_book"].replace(
+                "{ProductId}", productId
+            )
+            return self.Session.get(url, params=params, headers=headers, hooks=hooks)
+
         debug_data("GetContentAccessBook")
-        response = self.Session.get(url, params=params, headers=headers, hooks=hooks)
-        response.raise_for_status()
+        with Metrics.Time("content_access_book_seconds"):
+            response = self.__SendEndpointRequest(sendRequest)
         jsonResponse = response.json()
+
+        now = time.monotonic()
+        with Kobo.__ContentAccessBooksLock:
+            # Drop the expired responses so that bulk downloads don't pile them up.
+            for key, (fetched, _) in list(Kobo.__ContentAccessBooks.items()):
+                if now - fetched >= Kobo.ContentAccessBookTtl:
+                    del Kobo.__ContentAccessBooks[key]
+            Kobo.__ContentAccessBooks[cacheKey] = (now, jsonResponse)
         return jsonResponse
 
+    def __ForgetContentAccessBook(self, productId: str, displayProfile: str) -> None:
+        with Kobo.__ContentAccessBooksLock:
+            Kobo.__ContentAccessBooks.pop((self.user.DeviceId, productId, displayProfile), None)
+
     @staticmethod
     def __GetContentKeys(contentAccessBookResponse: dict) -> Dict[str, str]:
         jsonContentKeys = contentAccessBookResponse.get("ContentKeys")
@@ -257,7 +407,7 @@ class Kobo:
 
     def __GetDownloadInfo(
         self, bookMetadata: dict, isAudiobook: bool, displayProfile: str = None
-    ) -> Tuple[str, bool]:
+    ) -> Tuple[str, list]:
         displayProfile = displayProfile or Kobo.DisplayProfile
         productId = Kobo.GetProductId(bookMetadata)
 
@@ -304,7 +454,21 @@ class Kobo:
             message += f'\nDRMType: \'{jsonContentUrl["DRMType"]}\', UrlFormat: \'{jsonContentUrl["UrlFormat"]}\''
         raise KoboException(message)
 
-    def __DownloadToFile(self, url, outputPath: str) -> None:
+    @staticmethod
+    def __SaveValidator(response: requests.Response, validatorPath: str) -> None:
+        # Weak ETags can't be used in If-Range.
+        validator = response.headers.get("ETag", "")
+        if not validator or validator.startswith("W/"):
+            validator = response.headers.get("Last-Modified", "")
+        if validator:
+            with open(validatorPath, "w") as f:
+                f.write(validator)
+        elif os.path.isfile(validatorPath):
+            os.remove(validatorPath)
+
+    # A partially downloaded outputPath is resumed with a Range request when the server supports it. That is
+    # also how a connection that drops mid-transfer is retried; retry counts those attempts.
+    def __DownloadToFile(self, url, outputPath: str, retry: int = 0) -> None:
         headers = {}
         # Kobo serves content via storedownloads.kobo.com URLs that redirect to
         # requester-pays S3 presigned URLs (which sign host;x-amz-request-payer).
@@ -312,13 +476,86 @@ class Kobo:
         headers["x-amz-request-payer"] = "requester"
         if 'kobo.com' in url and 'amazonaws.com' not in url:
             headers.update(self.__GetHeaderWithAccessToken())
+
+        # The ETag (or Last-Modified date) of the file a partial download came from is kept next to it, so
+        # that it is only resumed while the server still has the same file.
+        validatorPath = outputPath + ".validator"
+        resumeFrom = os.path.getsize(outputPath) if os.path.isfile(outputPath) else 0
+        validator = ""
+        if resumeFrom > 0 and os.path.isfile(validatorPath):
+            with open(validatorPath, "r") as f:
+                validator = f.read()
+        if resumeFrom > 0 and validator:
+            headers["Range"] = f"bytes={resumeFrom}-"
+            # When the file changed, the server ignores Range and sends all of it, which starts over.
+            headers["If-Range"] = validator
+        elif resumeFrom > 0:
+            debug_data("DownloadToFile: no validator for partial file, restarting", outputPath)
+            resumeFrom = 0
+
         response = self.Session.get(url, headers=headers, stream=True)
+        if resumeFrom > 0 and response.status_code == requests.codes.range_not_satisfiable:  # 416
+            response.close()
+            # "bytes */<total>": the partial file is already complete if it has the full length.
+            if response.headers.get("Content-Range", "") == f"bytes */{resumeFrom}":
+                os.remove(validatorPath)
+                return
+            debug_data("DownloadToFile: discarding partial file", outputPath)
+            os.remove(outputPath)
+            os.remove(validatorPath)
+            return self.__DownloadToFile(url, outputPath, retry)
         response.raise_for_status()
-        with open(outputPath, "wb") as f:
-            for chunk in response.iter_content(chunk_size=1024 * 256):
-                f.write(chunk)
 
-    def __DownloadAudiobook(self, url, outputPath: str) -> None:
+        mode = "wb"
+        if resumeFrom > 0:
+            contentRange = response.headers.get("Content-Range", "")
+            if response.status_code == requests.codes.partial_content and contentRange.startswith(
+                f"bytes {resumeFrom}-"
+            ):
+                mode = "ab"
+            else:
+                # The file changed since (If-Range), or the server ignored the Range header, and the whole
+                # file was sent.
+                debug_data("DownloadToFile: not resuming", url, response.status_code)
+
+        try:
+            # Closing the response gives its host slot back, also when the transfer fails halfway.
+            with response, open(outputPath, mode) as f:
+                if mode == "wb":
+                    # Only once the old partial file is gone, so the two can't be mixed up.
+                    Kobo.__SaveValidator(response, validatorPath)
+                for chunk in response.iter_content(chunk_size=1024 * 256):
+                    Metrics.Increment("downloaded_bytes_total", len(chunk))
+                    Transport.RateLimiter.Consume(len(chunk))
+                    f.write(chunk)
+            if os.path.isfile(validatorPath):
+                os.remove(validatorPath)
+        except (requests.exceptions.ChunkedEncodingError, requests.ConnectionError) as err:
+            # The session only retries until the response headers arrive; this covers the body.
+            host = urllib.parse.urlsplit(url).netloc
+            if retry >= Transport.Policy.MaxRetries:
+                Transport.CountFailure(host, type(err).__name__)
+                raise
+            delay = Transport.GetBackoff(retry)
+            Transport.CountRetry(host, type(err).__name__, delay)
+            time.sleep(delay)
+            return self.__DownloadToFile(url, outputPath, retry + 1)
+
+    def __DownloadAudiobookPart(self, item: dict, outputPath: str) -> str:
+        fileNum = int(item['Id']) + 1
+        filePath = os.path.join(outputPath, str(fileNum) + '.' + item['FileExtension'])
+        # Parts only get their final name once complete, so finished parts from an earlier run are kept.
+        if os.path.isfile(filePath):
+            return filePath
+        temporaryFilePath = filePath + ".downloading"
+        # Spine entries are storedownloads.kobo.com URLs that redirect to requester-pays S3;
+        # __DownloadToFile sends the x-amz-request-payer header for us.
+        # A failed part keeps its .downloading file so the next attempt can resume it.
+        self.__DownloadToFile(item['Url'], temporaryFilePath)
+        os.replace(temporaryFilePath, filePath)
+        return filePath
+
+    def __DownloadAudiobook(self, url, outputPath: str, jobs: int = 1) -> None:
         headers = {}
         # See __DownloadToFile: send x-amz-request-payer unconditionally so it
         # survives the storedownloads.kobo.com -> S3 redirect.
@@ -328,24 +565,32 @@ class Kobo:
         response = self.Session.get(url, headers=headers)
 
         response.raise_for_status()
-        if not os.path.isdir(outputPath):
-            os.mkdir(outputPath)
+        # Like an ebook's .downloading file, the directory only gets its final name once every part is in
+        # it, so bulk downloads don't take a half finished audiobook for a downloaded one. One that
+        # already exists is completed in place.
+        partsPath = outputPath if os.path.isdir(outputPath) else outputPath + ".downloading"
+        if not os.path.isdir(partsPath):
+            os.mkdir(partsPath)
         data = response.json()
 
-        for item in data['Spine']:
-            fileNum = int(item['Id']) + 1
-            fileUrl = item['Url']
-            fileHeaders = {}
-            # Spine entries are storedownloads.kobo.com URLs that redirect to
-            # requester-pays S3; send the header unconditionally so it survives.
-            fileHeaders["x-amz-request-payer"] = "requester"
-            if 'kobo.com' in fileUrl and 'amazonaws.com' not in fileUrl:
-                fileHeaders.update(self.__GetHeaderWithAccessToken())
-            response = self.Session.get(fileUrl, headers=fileHeaders, stream=True)
-            filePath = os.path.join(outputPath, str(fileNum) + '.' + item['FileExtension'])
-            with open(filePath, "wb") as f:
-                for chunk in response.iter_content(chunk_size=1024 * 256):
-                    f.write(chunk)
+        spine = data['Spine']
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = [
+                executor.submit(self.__DownloadAudiobookPart, item, partsPath) for item in spine
+            ]
+            try:
+                for finished, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    filePath = future.result()
+                    print(
+                        f"  part {finished}/{len(spine)} done: {os.path.basename(filePath)}",
+                        file=sys.stderr,
+                    )
+            except:
+                for future in futures:
+                    future.cancel()
+                raise
+        if partsPath != outputPath:
+            os.replace(partsPath, outputPath)
 
     @staticmethod
     def __GenerateRandomHexDigitString(length: int) -> str:
@@ -380,7 +625,7 @@ class Kobo:
         if len(userKey) > 0:
             postData["UserKey"] = userKey
 
-        response = self.Session.post("https://storeapi.kobo.com/v1/auth/device", json=postData)
+        response = self.Session.post(f"{Kobo.StoreApiUrl}/v1/auth/device", json=postData)
         debug_data("AuthenticateDevice", response.text)
         response.raise_for_status()
         jsonResponse = response.json()
@@ -403,82 +648,227 @@ class Kobo:
 
     # Downloading archived books is not possible, the "content_access_book" API endpoint returns with empty ContentKeys
     # and ContentUrls for them.
-    def Download(self, bookMetadata: dict, isAudiobook: bool, outputPath: str) -> None:
+    def __TransferBook(
+        self, downloadUrl: str, isAudiobook: bool, outputPath: str, audiobookJobs: int
+    ) -> None:
+        if isAudiobook:
+            self.__DownloadAudiobook(downloadUrl, outputPath, audiobookJobs)
+        else:
+            self.__DownloadToFile(downloadUrl, outputPath + ".downloading")
+
+    @staticmethod
+    def __IsExpiredDownloadUrlError(err: requests.HTTPError) -> bool:
+        # Both storedownloads.kobo.com and the presigned S3 URLs it redirects to answer expired links like this.
+        return err.response is not None and err.response.status_code in [
+            requests.codes.unauthorized,  # 401
+            requests.codes.forbidden,  # 403
+            requests.codes.gone,  # 410
+        ]
+
+    # Audiobook download URLs come from the library metadata, which can be older than the URLs' lifetime
+    # when it was served from the LibraryStore. A full sync is the only way to get new ones.
+    def __GetFreshBookMetadata(self, bookMetadata: dict) -> dict:
+        productId = Kobo.GetProductId(bookMetadata)
+        for entitlement in self.GetMyBookList(fullSync=True):
+            newEntitlement = entitlement.get('NewEntitlement', {})
+            for key in ['BookMetadata', 'AudiobookMetadata']:
+                freshMetadata = newEntitlement.get(key)
+                if freshMetadata and Kobo.GetProductId(freshMetadata) == productId:
+                    return freshMetadata
+        raise KoboException(f"Product {productId} is no longer in the library.")
+
+    # Downloading happens in three stages: PrepareDownload resolves the download URL, TransferDownload fetches
+    # the bytes and FinishDownload removes the DRM. Download runs them one after the other; bulk downloads can
+    # run them in a pipeline instead.
+    def PrepareDownload(
+        self, bookMetadata: dict, isAudiobook: bool, outputPath: str
+    ) -> DownloadInfo:
         downloadUrl, hasDrm = self.__GetDownloadInfo(bookMetadata, isAudiobook)
-        revisionId = Kobo.GetProductId(bookMetadata)
+        return DownloadInfo(
+            BookMetadata=bookMetadata,
+            IsAudiobook=isAudiobook,
+            OutputPath=outputPath,
+            Url=downloadUrl,
+            HasDrm=hasDrm,
+        )
+
+    # Audiobooks are made of many parts; up to audiobookJobs of them are downloaded at the same time.
+    def TransferDownload(self, info: DownloadInfo, audiobookJobs: int = 4) -> None:
+        # A failed transfer keeps the .downloading file (or directory of audiobook parts) so that
+        # the next attempt resumes it instead of starting from zero.
+        with Metrics.Time("transfer_seconds", kind="audiobook" if info.IsAudiobook else "ebook"):
+            try:
+                self.__TransferBook(info.Url, info.IsAudiobook, info.OutputPath, audiobookJobs)
+            except requests.HTTPError as err:
+                if not Kobo.__IsExpiredDownloadUrlError(err):
+                    raise
+                print("Download URL has expired, requesting a new one...", file=sys.stderr)
+                if info.IsAudiobook:
+                    info.BookMetadata = self.__GetFreshBookMetadata(info.BookMetadata)
+                else:
+                    # The cached response has the same stale URL in it.
+                    self.__ForgetContentAccessBook(
+                        Kobo.GetProductId(info.BookMetadata), Kobo.DisplayProfile
+                    )
+                info.Url, info.HasDrm = self.__GetDownloadInfo(info.BookMetadata, info.IsAudiobook)
+                self.__TransferBook(info.Url, info.IsAudiobook, info.OutputPath, audiobookJobs)
+
+    # decryptWorkers is the number of threads KoboDrmRemover uses.
+    def FinishDownload(self, info: DownloadInfo, decryptWorkers: int = 1) -> None:
+        revisionId = Kobo.GetProductId(info.BookMetadata)
+        outputPath = info.OutputPath
         temporaryOutputPath = outputPath + ".downloading"
+        # The book only gets its final name once it is complete, as a file at outputPath is taken to be
+        # already downloaded.
+        decryptedOutputPath = outputPath + ".decrypting"
 
         try:
-            if isAudiobook:
-                self.__DownloadAudiobook(downloadUrl, outputPath)
-            else:
-                self.__DownloadToFile(downloadUrl, temporaryOutputPath)
-
-            if hasDrm:
-                if hasDrm[0] == 'AdobeDrm':
+            if info.HasDrm:
+                if info.HasDrm[0] == 'AdobeDrm':
                     print(
                         "WARNING: Unable to parse the Adobe Digital Editions DRM. Saving it as an encrypted 'ade' file.",
                         "Try https://github.com/apprenticeharper/DeDRM_tools",
                     )
-                    copyfile(temporaryOutputPath, outputPath + ".ade")
+                    os.replace(temporaryOutputPath, outputPath + ".ade")
                 else:
+                    # Usually still cached from PrepareDownload; after this it is no longer needed.
                     contentAccessBook = self.__GetContentAccessBook(revisionId, self.DisplayProfile)
+                    self.__ForgetContentAccessBook(revisionId, self.DisplayProfile)
                     contentKeys = Kobo.__GetContentKeys(contentAccessBook)
+                    # Imported here so that commands which don't decrypt anything don't load Crypto.
+                    from kobodl.koboDrmRemover import KoboDrmRemover
+
                     drmRemover = KoboDrmRemover(self.user.DeviceId, self.user.UserId)
-                    drmRemover.RemoveDrm(temporaryOutputPath, outputPath, contentKeys)
-                os.remove(temporaryOutputPath)
+                    with Metrics.Time("drm_removal_seconds"):
+                        drmRemover.RemoveDrm(
+                            temporaryOutputPath,
+                            decryptedOutputPath,
+                            contentKeys,
+                            workers=decryptWorkers,
+                        )
+                    os.replace(decryptedOutputPath, outputPath)
+                    os.remove(temporaryOutputPath)
             else:
-                if not isAudiobook:
+                if not info.IsAudiobook:
                     os.rename(temporaryOutputPath, outputPath)
         except:
             if os.path.isfile(temporaryOutputPath):
                 os.remove(temporaryOutputPath)
-            if os.path.isfile(outputPath):
-                os.remove(outputPath)
+            if os.path.isfile(decryptedOutputPath):
+                os.remove(decryptedOutputPath)
 
             raise
 
+    def Download(
+        self,
+        bookMetadata: dict,
+        isAudiobook: bool,
+        outputPath: str,
+        audiobookJobs: int = 4,
+        decryptWorkers: int = 1,
+    ) -> DownloadInfo:
+        info = self.PrepareDownload(bookMetadata, isAudiobook, outputPath)
+        self.TransferDownload(info, audiobookJobs)
+        self.FinishDownload(info, decryptWorkers)
+        return info
+
     # The "library_sync" name and the synchronization tokens make it somewhat suspicious that we should use
     # "library_items" instead to get the My Books list, but "library_items" gives back less info (even with the
     # embed=ProductMetadata query parameter set).
-    def GetMyBookList(self) -> list:
+    # The library is kept in a per-user LibraryStore, so only the changes since the last sync are fetched.
+    # Pass fullSync to throw the local copy away and fetch everything again.
+    def GetMyBookList(self, fullSync: bool = False) -> list:
+        store = self.__OpenLibraryStore(fullSync)
+        for _ in self.__SyncLibraryStore(store):
+            pass
+        return store.GetBookList()
+
+    # Like GetMyBookList, but a generator: during a full sync, the entitlements of each library_sync page are
+    # yielded as soon as the page arrives, so callers can start working on them while later pages load. An
+    # incremental sync only fetches changes, which may affect any stored entitlement, so it completes before
+    # the stored library is yielded. The store is only saved once the generator is exhausted; a caller that
+    # stops early leaves the previous sync token in place.
+    def IterMyBookList(self, fullSync: bool = False) -> Generator[dict, None, None]:
+        store = self.__OpenLibraryStore(fullSync)
+        incremental = len(store.SyncToken) > 0
+        yielded = set()
+        for bookList in self.__SyncLibraryStore(store):
+            if incremental:
+                continue
+            for item in bookList:
+                entitlementId = LibraryStore.GetEntitlementId(item.get("NewEntitlement", {}))
+                if entitlementId is None or entitlementId in yielded:
+                    continue
+                yielded.add(entitlementId)
+                yield store.Entitlements[entitlementId]
+        if incremental:
+            yield from store.GetBookList()
+
+    def __OpenLibraryStore(self, fullSync: bool) -> LibraryStore:
         if not self.user.AreAuthenticationSettingsSet():
             raise NotAuthenticatedException(f'User {self.user.Email} is not authenticated')
 
-        fullBookList = []
-        syncToken = ""
-        while True:
-            bookList, syncToken = self.__GetMyBookListPage(syncToken)
-            fullBookList += bookList
-            if len(syncToken) == 0:
-                break
-
-        return fullBookList
-
-    def GetMyWishList(self) -> list:
-        items = []
-        currentPageIndex = 0
+        store = self.__GetLibraryStore()
+        if fullSync:
+            store.Clear()
+        return store
 
+    # Yields every page after merging it into the store, and saves the store after the last one.
+    def __SyncLibraryStore(self, store: LibraryStore) -> Generator[list, None, None]:
+        syncToken = store.SyncToken
         while True:
-            url = self.InitializationSettings["user_wishlist"]
-            headers = self.__GetHeaderWithAccessToken()
-            hooks = self.__GetReauthenticationHook()
+            try:
+                bookList, syncToken, hasMore = self.__GetMyBookListPage(syncToken)
+            except requests.HTTPError:
+                if len(store.SyncToken) == 0:
+                    raise
+                # The stored token may have been rejected; start over with a full sync.
+                debug_data("GetMyBookList: incremental sync failed, doing a full sync")
+                store.Clear()
+                syncToken = ""
+                continue
+            store.Merge(bookList)
+            yield bookList
+            if not hasMore:
+                break
 
-            params = {
-                "PageIndex": currentPageIndex,
-                "PageSize": 100,  # 100 is the default if PageSize is not specified.
-            }
+        store.SyncToken = syncToken
+        store.Save()
 
-            debug_data("GetMyWishList")
-            response = self.Session.get(url, params=params, headers=headers, hooks=hooks)
-            response.raise_for_status()
-            wishList = response.json()
+    def __GetMyWishListPage(self, pageIndex: int, pageSize: int) -> dict:
+        headers = self.__GetHeaderWithAccessToken()
+        hooks = self.__GetReauthenticationHook()
 
-            items.extend(wishList["Items"])
+        params = {
+            "PageIndex": pageIndex,
+            "PageSize": pageSize,
+        }
 
-            currentPageIndex += 1
-            if currentPageIndex >= wishList["TotalPageCount"]:
-                break
+        debug_data("GetMyWishList")
+        response = self.__SendEndpointRequest(
+            lambda: self.Session.get(
+                self.InitializationSettings["user_wishlist"],
+                params=params,
+                headers=headers,
+                hooks=hooks,
+            )
+        )
+        return response.json()
+
+    # The page count is only known after the first page, so the first page is fetched alone and the rest,
+    # up to jobs at a time, after it. 100 is the server's default if PageSize is not specified.
+    def GetMyWishList(self, pageSize: int = 100, jobs: int = 4) -> list:
+        firstPage = self.__GetMyWishListPage(0, pageSize)
+        items = list(firstPage["Items"])
+
+        pageIndexes = range(1, firstPage["TotalPageCount"])
+        if len(pageIndexes) > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+                # map keeps the pages in order.
+                for page in executor.map(
+                    lambda pageIndex: self.__GetMyWishListPage(pageIndex, pageSize), pageIndexes
+                ):
+                    items.extend(page["Items"])
 
         return items
 
@@ -497,23 +887,63 @@ class Kobo:
         jsonResponse = response.json()
         return jsonResponse
 
-    def LoadInitializationSettings(self) -> None:
+    def __GetInitializationSettingsCachePath(self) -> Union[str, None]:
+        if Globals.Settings is None or len(self.user.DeviceId) == 0:
+            return None
+        return Globals.Settings.GetCachePath(f"initialization-{self.user.DeviceId}.json")
+
+    def __LoadCachedInitializationSettings(self) -> Union[dict, None]:
+        cachePath = self.__GetInitializationSettingsCachePath()
+        if cachePath is None or not os.path.isfile(cachePath):
+            return None
+        try:
+            with open(cachePath, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as err:
+            debug_data("Ignoring unreadable initialization settings cache", err)
+            return None
+        if time.time() - cached.get("FetchedAt", 0) > Kobo.InitializationSettingsTtl:
+            return None
+        return cached.get("Resources")
+
+    def __SaveCachedInitializationSettings(self) -> None:
+        cachePath = self.__GetInitializationSettingsCachePath()
+        if cachePath is None:
+            return
+        try:
+            WriteJsonFile(
+                cachePath, {"FetchedAt": time.time(), "Resources": self.InitializationSettings}
+            )
+        except OSError as err:
+            debug_data("Could not save initialization settings cache", err)
+
+    def LoadInitializationSettings(self, useCache: bool = True) -> None:
         """
         to be called when authentication has been done
+        the Resources map rarely changes, so it is cached on disk for InitializationSettingsTtl seconds
         """
+        if useCache:
+            cached = self.__LoadCachedInitializationSettings()
+            if cached:
+                self.InitializationSettings = cached
+                self.InitializationSettingsFromCache = True
+                return
+
         headers = self.__GetHeaderWithAccessToken()
         hooks = self.__GetReauthenticationHook()
         debug_data("LoadInitializationSettings")
         response = self.Session.get(
-            "https://storeapi.kobo.com/v1/initialization", headers=headers, hooks=hooks
+            f"{Kobo.StoreApiUrl}/v1/initialization", headers=headers, hooks=hooks
         )
         try:
             response.raise_for_status()
             jsonResponse = response.json()
             self.InitializationSettings = jsonResponse["Resources"]
+            self.InitializationSettingsFromCache = False
         except requests.HTTPError as err:
             print(response.reason, response.text)
             raise err
+        self.__SaveCachedInitializationSettings()
 
     def Login(self) -> None:
         activationCheckUrl, activationCode = self.__ActivateOnWeb()
@@ -1,15 +1,50 @@
 import base64
 import binascii
+import collections
+import concurrent.futures
 import hashlib
+import os
+import shutil
+import struct
 import zipfile
-from typing import Dict
+import zlib
+from typing import BinaryIO, Dict, Iterable, List, Tuple
 
 from Crypto.Cipher import AES
 from Crypto.Util import Padding
 
 
+class _DeflatingWriter:
+    '''file-like sink that deflates what is written to it the same way ZIP_DEFLATED entries are'''
+
+    def __init__(self):
+        self.Compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS
+        )
+        self.Chunks: List[bytes] = []
+        self.CRC = 0
+        self.FileSize = 0
+
+    def write(self, data: bytes) -> int:
+        self.CRC = zlib.crc32(data, self.CRC)
+        self.FileSize += len(data)
+        self.Chunks.append(self.Compressor.compress(data))
+        return len(data)
+
+    def close(self) -> None:
+        self.Chunks.append(self.Compressor.flush())
+
+
 # Based on obok.py by Physisticated.
 class KoboDrmRemover:
+    # Entries are streamed through in pieces of this size, which bounds the memory used per entry.
+    ChunkSize = 1024 * 1024
+
+    # Local file header layout from the ZIP specification (APPNOTE.TXT, section 4.3.7).
+    LocalFileHeaderSize = 30
+    EncryptedFlag = 0x01
+    DataDescriptorFlag = 0x08
+
     def __init__(self, deviceId: str, userId: str):
         self.DeviceIdUserIdKey = KoboDrmRemover.__MakeDeviceIdUserIdKey(deviceId, userId)
 
@@ -19,24 +54,210 @@ class KoboDrmRemover:
         key = hashlib.sha256(deviceIdUserId).hexdigest()
         return binascii.a2b_hex(key[32:])
 
-    def __DecryptContents(self, contents: bytes, contentKeyBase64: str) -> bytes:
+    def __MakeContentAes(self, contentKeyBase64: str):
         contentKey = base64.b64decode(contentKeyBase64)
         keyAes = AES.new(self.DeviceIdUserIdKey, AES.MODE_ECB)
         decryptedContentKey = keyAes.decrypt(contentKey)
+        return AES.new(decryptedContentKey, AES.MODE_ECB)
+
+    def __DecryptStream(
+        self, inputFile: BinaryIO, outputFile: BinaryIO, contentKeyBase64: str, chunkSize: int
+    ) -> None:
+        contentAes = self.__MakeContentAes(contentKeyBase64)
+        pending = b""
+        while True:
+            chunk = inputFile.read(chunkSize)
+            if not chunk:
+                break
+            pending += chunk
+            # ECB works block by block, so whole blocks can be decrypted as they come in. The last block
+            # is always held back because it carries the PKCS7 padding and we only know it is last at EOF.
+            ready = (len(pending) - 1) // AES.block_size * AES.block_size
+            if ready > 0:
+                outputFile.write(contentAes.decrypt(pending[:ready]))
+                pending = pending[ready:]
+        outputFile.write(Padding.unpad(contentAes.decrypt(pending), AES.block_size, "pkcs7"))
+
+    @staticmethod
+    def __MakeOutputInfo(inputInfo: zipfile.ZipInfo) -> zipfile.ZipInfo:
+        outputInfo = zipfile.ZipInfo(inputInfo.filename, date_time=inputInfo.date_time)
+        outputInfo.external_attr = inputInfo.external_attr
+        if inputInfo.filename == "mimetype":
+            outputInfo.compress_type = zipfile.ZIP_STORED
+        else:
+            outputInfo.compress_type = zipfile.ZIP_DEFLATED
+        return outputInfo
+
+    @staticmethod
+    def __WriteRawEntry(
+        outputZip: zipfile.ZipFile, outputInfo: zipfile.ZipInfo, chunks: Iterable[bytes]
+    ) -> None:
+        '''write an entry whose data is already compressed and whose CRC and sizes are already set'''
+        # zipfile has no public API for this, so do what ZipFile.writestr does under the hood.
+        with outputZip._lock:
+            if outputZip._writing:
+                raise ValueError("Can't write a raw entry while another entry is being written.")
+            outputZip._writecheck(outputInfo)
+            outputZip._didModify = True
+            outputZip.fp.seek(outputZip.start_dir)
+            outputInfo.header_offset = outputZip.fp.tell()
+            zip64 = max(outputInfo.file_size, outputInfo.compress_size) > zipfile.ZIP64_LIMIT
+            outputZip.fp.write(outputInfo.FileHeader(zip64))
+            written = 0
+            for chunk in chunks:
+                outputZip.fp.write(chunk)
+                written += len(chunk)
+            if written != outputInfo.compress_size:
+                raise zipfile.BadZipFile(f"Truncated entry {outputInfo.filename}")
+            outputZip.start_dir = outputZip.fp.tell()
+            outputZip.filelist.append(outputInfo)
+            outputZip.NameToInfo[outputInfo.filename] = outputInfo
 
-        contentAes = AES.new(decryptedContentKey, AES.MODE_ECB)
-        decryptedContents = contentAes.decrypt(contents)
-        return Padding.unpad(decryptedContents, AES.block_size, "pkcs7")
+    @staticmethod
+    def __CopyRawEntry(
+        rawInputFile: BinaryIO,
+        outputZip: zipfile.ZipFile,
+        inputInfo: zipfile.ZipInfo,
+        chunkSize: int,
+    ) -> None:
+        '''copy an entry's compressed bytes as they are, without inflating and deflating them again'''
+        rawInputFile.seek(inputInfo.header_offset)
+        localHeader = rawInputFile.read(KoboDrmRemover.LocalFileHeaderSize)
+        if localHeader[:4] != b"PK\x03\x04":
+            raise zipfile.BadZipFile(f"Bad local file header for {inputInfo.filename}")
+        fileNameLength, extraLength = struct.unpack("<HH", localHeader[26:30])
+        rawInputFile.seek(fileNameLength + extraLength, os.SEEK_CUR)
+
+        outputInfo = zipfile.ZipInfo(inputInfo.filename, date_time=inputInfo.date_time)
+        outputInfo.external_attr = inputInfo.external_attr
+        outputInfo.compress_type = inputInfo.compress_type
+        # The sizes and CRC are known up front, so no data descriptor is written after the data.
+        outputInfo.flag_bits = inputInfo.flag_bits & ~KoboDrmRemover.DataDescriptorFlag
+        outputInfo.CRC = inputInfo.CRC
+        outputInfo.compress_size = inputInfo.compress_size
+        outputInfo.file_size = inputInfo.file_size
+
+        def readChunks():
+            remaining = inputInfo.compress_size
+            while remaining > 0:
+                chunk = rawInputFile.read(min(chunkSize, remaining))
+                if not chunk:
+                    return
+                yield chunk
+                remaining -= len(chunk)
+
+        KoboDrmRemover.__WriteRawEntry(outputZip, outputInfo, readChunks())
+
+    def __DecryptAndCompressEntry(
+        self,
+        inputZip: zipfile.ZipFile,
+        inputInfo: zipfile.ZipInfo,
+        contentKeyBase64: str,
+        chunkSize: int,
+    ) -> Tuple[zipfile.ZipInfo, List[bytes]]:
+        '''runs in a worker thread; the result is written to the output by __WriteRawEntry'''
+        writer = _DeflatingWriter()
+        with inputZip.open(inputInfo) as inputFile:
+            self.__DecryptStream(inputFile, writer, contentKeyBase64, chunkSize)
+        writer.close()
+
+        outputInfo = KoboDrmRemover.__MakeOutputInfo(inputInfo)
+        outputInfo.CRC = writer.CRC
+        outputInfo.file_size = writer.FileSize
+        outputInfo.compress_size = sum(len(chunk) for chunk in writer.Chunks)
+        return outputInfo, writer.Chunks
 
-    def RemoveDrm(self, inputPath: str, outputPath: str, contentKeys: Dict[str, str]) -> None:
-        with zipfile.ZipFile(inputPath, "r") as inputZip:
+    def __WriteEntry(
+        self,
+        inputZip: zipfile.ZipFile,
+        rawInputFile: BinaryIO,
+        outputZip: zipfile.ZipFile,
+        inputInfo: zipfile.ZipInfo,
+        contentKeyBase64: str,
+        chunkSize: int,
+    ) -> None:
+        # Entries without a content key (fonts, CSS, images...) only need to be copied.
+        if (
+            contentKeyBase64 is None
+            and inputInfo.filename != "mimetype"
+            and not inputInfo.flag_bits & KoboDrmRemover.EncryptedFlag
+        ):
+            KoboDrmRemover.__CopyRawEntry(rawInputFile, outputZip, inputInfo, chunkSize)
+            return
+
+        outputInfo = KoboDrmRemover.__MakeOutputInfo(inputInfo)
+        forceZip64 = inputInfo.file_size >= zipfile.ZIP64_LIMIT
+        with inputZip.open(inputInfo) as inputFile:
+            with outputZip.open(outputInfo, "w", force_zip64=forceZip64) as outputFile:
+                if contentKeyBase64 is not None:
+                    self.__DecryptStream(inputFile, outputFile, contentKeyBase64, chunkSize)
+                else:
+                    shutil.copyfileobj(inputFile, outputFile, chunkSize)
+
+    # With workers > 1 the encrypted entries are decrypted and compressed in a thread pool. Both AES
+    # (pycryptodome) and zlib release the GIL while they work, so this spreads over several cores. The
+    # output is still assembled in the original entry order; at most 2 * workers compressed entries are
+    # held in memory at a time.
+    def RemoveDrm(
+        self,
+        inputPath: str,
+        outputPath: str,
+        contentKeys: Dict[str, str],
+        chunkSize: int = ChunkSize,
+        workers: int = 1,
+    ) -> None:
+        with zipfile.ZipFile(inputPath, "r") as inputZip, open(inputPath, "rb") as rawInputFile:
             with zipfile.ZipFile(outputPath, "w", zipfile.ZIP_DEFLATED) as outputZip:
-                for filename in inputZip.namelist():
-                    contents = inputZip.read(filename)
-                    contentKeyBase64 = contentKeys.get(filename, None)
-                    if contentKeyBase64 is not None:
-                        contents = self.__DecryptContents(contents, contentKeyBase64)
-                    if filename == "mimetype":
-                        outputZip.writestr(filename, contents, compress_type=zipfile.ZIP_STORED)
-                    else:
-                        outputZip.writestr(filename, contents)
+                # The EPUB specification requires mimetype to be the first entry, stored uncompressed.
+                inputInfos = sorted(
+                    inputZip.infolist(), key=lambda info: info.filename != "mimetype"
+                )
+
+                if workers <= 1:
+                    for inputInfo in inputInfos:
+                        contentKeyBase64 = contentKeys.get(inputInfo.filename, None)
+                        self.__WriteEntry(
+                            inputZip,
+                            rawInputFile,
+                            outputZip,
+                            inputInfo,
+                            contentKeyBase64,
+                            chunkSize,
+                        )
+                    return
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    pending = collections.deque()
+
+                    def writeNext():
+                        inputInfo, future = pending.popleft()
+                        if future is None:
+                            self.__WriteEntry(
+                                inputZip, rawInputFile, outputZip, inputInfo, None, chunkSize
+                            )
+                        else:
+                            outputInfo, chunks = future.result()
+                            KoboDrmRemover.__WriteRawEntry(outputZip, outputInfo, chunks)
+
+                    try:
+                        for inputInfo in inputInfos:
+                            contentKeyBase64 = contentKeys.get(inputInfo.filename, None)
+                            future = None
+                            if contentKeyBase64 is not None and not inputInfo.is_dir():
+                                future = executor.submit(
+                                    self.__DecryptAndCompressEntry,
+                                    inputZip,
+                                    inputInfo,
+                                    contentKeyBase64,
+                                    chunkSize,
+                                )
+                            pending.append((inputInfo, future))
+                            while len(pending) > 2 * workers:
+                                writeNext()
+                        while pending:
+                            writeNext()
+                    except:
+                        for _, future in pending:
+                            if future is not None:
+                                future.cancel()
+                        raise
@@ -0,0 +1,214 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, List, TextIO, Union
+
+from kobodl.debug import debug_data
+
+
+def WriteJsonFile(path: str, data) -> None:
+    '''
+    replace the file at path with data as JSON, without a reader ever seeing half of it
+    the temporary file has a unique name, so processes sharing the cache directory can't clash
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temporaryPath = tempfile.mkstemp(dir=directory, prefix='.kobodl-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temporaryPath, path)
+    except BaseException:
+        os.remove(temporaryPath)
+        raise
+
+
+class LibraryStore:
+    '''
+    On-disk copy of a user's library_sync results.
+
+    Holds the last x-kobo-synctoken along with every entitlement seen so far, so
+    that later syncs only need to fetch what changed since then.
+    Entitlements are stored in the same {'NewEntitlement': {...}} shape that
+    library_sync returns them in.
+    '''
+
+    def __init__(self, path: Union[str, None]):
+        self.Path = path
+        self.SyncToken = ''
+        self.Entitlements: Dict[str, dict] = {}
+        self.Load()
+
+    @staticmethod
+    def GetEntitlementId(entitlement: dict) -> Union[str, None]:
+        for key in ['BookEntitlement', 'AudiobookEntitlement', 'BookSubscriptionEntitlement']:
+            inner = entitlement.get(key)
+            if inner and inner.get('Id'):
+                return inner['Id']
+        for key in ['BookMetadata', 'AudiobookMetadata']:
+            metadata = entitlement.get(key)
+            if metadata and metadata.get('RevisionId'):
+                return metadata['RevisionId']
+        return None
+
+    def Load(self) -> None:
+        if not self.Path or not os.path.isfile(self.Path):
+            return
+        try:
+            with open(self.Path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as err:
+            # A broken store only costs us a full sync, so don't fail on it.
+            debug_data('LibraryStore: ignoring unreadable store', self.Path, err)
+            return
+        self.SyncToken = data.get('SyncToken', '')
+        for item in data.get('Entitlements', []):
+            entitlementId = LibraryStore.GetEntitlementId(item.get('NewEntitlement', {}))
+            if entitlementId:
+                self.Entitlements[entitlementId] = item
+
+    def Save(self) -> None:
+        if not self.Path:
+            return
+        data = {
+            'SyncToken': self.SyncToken,
+            'Entitlements': list(self.Entitlements.values()),
+        }
+        try:
+            WriteJsonFile(self.Path, data)
+        except OSError as err:
+            debug_data('LibraryStore: could not save store', self.Path, err)
+
+    def Clear(self) -> None:
+        self.SyncToken = ''
+        self.Entitlements = {}
+
+    def Merge(self, syncItems: List[dict]) -> None:
+        '''merge one page of library_sync results into the store'''
+        for item in syncItems:
+            if 'NewEntitlement' in item:
+                self.__MergeEntitlement(item['NewEntitlement'])
+            elif 'ChangedEntitlement' in item:
+                # Changed entitlements carry the updated state, e.g. IsRemoved for archived books.
+                self.__MergeEntitlement(item['ChangedEntitlement'])
+            elif 'ChangedReadingState' in item:
+                readingState = item['ChangedReadingState'].get('ReadingState', {})
+                stored = self.Entitlements.get(readingState.get('EntitlementId'))
+                if stored is not None:
+                    stored['NewEntitlement']['ReadingState'] = readingState
+            elif 'ChangedProductMetadata' in item:
+                changed = item['ChangedProductMetadata']
+                for key in ['BookMetadata', 'AudiobookMetadata']:
+                    metadata = changed.get(key)
+                    if metadata is None:
+                        continue
+                    stored = self.Entitlements.get(metadata.get('RevisionId'))
+                    if stored is not None:
+                        stored['NewEntitlement'][key] = metadata
+
+    def __MergeEntitlement(self, entitlement: dict) -> None:
+        entitlementId = LibraryStore.GetEntitlementId(entitlement)
+        if entitlementId is None:
+            debug_data('LibraryStore: entitlement without an id', entitlement)
+            return
+        stored = self.Entitlements.get(entitlementId)
+        if stored is None:
+            self.Entitlements[entitlementId] = {'NewEntitlement': entitlement}
+            return
+        merged = stored['NewEntitlement']
+        for key, value in entitlement.items():
+            if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = {**merged[key], **value}
+            else:
+                merged[key] = value
+
+    def GetBookList(self) -> list:
+        return list(self.Entitlements.values())
+
+
+class LibraryExport:
+    '''
+    Writes library_sync entitlements to a file as newline-delimited JSON, one entitlement per line,
+    so they can be written as they arrive instead of all at once. Paths ending in .gz are gzip
+    compressed.
+    Several threads may write to the same export, e.g. one per account, so every line says which
+    account it belongs to in "Owner".
+    '''
+
+    def __init__(self, path: str):
+        self.Path = path
+        self.__Lock = threading.Lock()
+        self.__File: TextIO
+        if path.endswith('.gz'):
+            self.__File = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self.__File = open(path, 'w', encoding='utf-8')
+
+    def __enter__(self) -> 'LibraryExport':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Close()
+
+    def Write(self, item: dict, owner: str) -> None:
+        line = json.dumps({'Owner': owner, **item}, separators=(',', ':')) + '\n'
+        with self.__Lock:
+            self.__File.write(line)
+
+    def WriteRemoved(self, entitlementId: str, owner: str) -> None:
+        '''used by delta exports for entitlements that were exported before but are gone now'''
+        self.Write({'RemovedEntitlement': {'Id': entitlementId}}, owner)
+
+    def Close(self) -> None:
+        with self.__Lock:
+            self.__File.close()
+
+
+class ExportFingerprints:
+    '''
+    A hash of every entitlement in a user's previous export, kept on disk. A delta export only
+    writes the entitlements whose hash changed, or that were not exported before.
+    '''
+
+    def __init__(self, path: Union[str, None]):
+        self.Path = path
+        self.Previous: Dict[str, str] = {}
+        self.Current: Dict[str, str] = {}
+        self.Load()
+
+    @staticmethod
+    def GetFingerprint(item: dict) -> str:
+        data = json.dumps(item, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def Load(self) -> None:
+        if not self.Path or not os.path.isfile(self.Path):
+            return
+        try:
+            with open(self.Path, 'r', encoding='utf-8') as f:
+                self.Previous = json.load(f).get('Fingerprints', {})
+        except (OSError, ValueError) as err:
+            # Losing these only makes the next delta export a full one.
+            debug_data('ExportFingerprints: ignoring unreadable fingerprints', self.Path, err)
+
+    def IsChanged(self, entitlementId: str, item: dict) -> bool:
+        '''remember the entitlement as exported; tell whether it changed since the last export'''
+        fingerprint = ExportFingerprints.GetFingerprint(item)
+        self.Current[entitlementId] = fingerprint
+        return self.Previous.get(entitlementId) != fingerprint
+
+    def GetRemoved(self) -> List[str]:
+        return [
+            entitlementId for entitlementId in self.Previous if entitlementId not in self.Current
+        ]
+
+    def Save(self) -> None:
+        if not self.Path:
+            return
+        try:
+            WriteJsonFile(self.Path, {'Fingerprints': self.Current})
+        except OSError as err:
+            debug_data('ExportFingerprints: could not save fingerprints', self.Path, err)
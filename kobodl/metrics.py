@@ -0,0 +1,138 @@
+import contextlib
+import dataclasses
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+@dataclasses.dataclass
+class Timer:
+    Count: int = 0
+    Sum: float = 0.0
+    Max: float = 0.0
+
+
+class Metrics:
+    '''
+    Process-wide counters and timers, shared by every thread like Transport is.
+    They are printed as JSON at the end of a CLI run with --metrics, and served by `kobodl serve` at
+    /metrics in the Prometheus text format.
+    '''
+
+    Prefix = 'kobodl_'
+    __Lock = threading.Lock()
+    __Counters: Dict[str, Dict[Labels, float]] = {}
+    __Timers: Dict[str, Dict[Labels, Timer]] = {}
+    __Help: Dict[str, str] = {
+        'http_requests_total': 'HTTP requests sent, by host and status (or exception name)',
+        'http_request_seconds': 'HTTP request latency until the response headers, by host',
+        'http_retries_total': 'HTTP requests retried, by host and reason',
+        'http_backoff_seconds_total': 'time spent waiting before retrying HTTP requests, by host',
+        'http_failures_total': 'HTTP requests given up on after retrying, by host and reason',
+        'token_refreshes_total': 'access token refreshes, by reason',
+        'downloaded_bytes_total': 'bytes of book and audiobook content downloaded',
+        'library_sync_page_seconds': 'time to fetch one library_sync page',
+        'content_access_book_seconds': 'time to fetch content_access_book for one book',
+        'transfer_seconds': 'time to download one book or audiobook',
+        'drm_removal_seconds': 'time to remove the DRM from one book',
+        'books_downloaded_total': 'books downloaded, by result',
+    }
+
+    @staticmethod
+    def __MakeLabels(labels: Dict[str, object]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    @staticmethod
+    def Increment(name: str, value: float = 1, **labels) -> None:
+        key = Metrics.__MakeLabels(labels)
+        with Metrics.__Lock:
+            counter = Metrics.__Counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    @staticmethod
+    def Observe(name: str, seconds: float, **labels) -> None:
+        key = Metrics.__MakeLabels(labels)
+        with Metrics.__Lock:
+            timer = Metrics.__Timers.setdefault(name, {}).setdefault(key, Timer())
+            timer.Count += 1
+            timer.Sum += seconds
+            timer.Max = max(timer.Max, seconds)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def Time(name: str, **labels) -> Iterator[None]:
+        '''time the block; failed attempts are timed too, with result="error"'''
+        start = time.perf_counter()
+        result = 'ok'
+        try:
+            yield
+        except BaseException:
+            result = 'error'
+            raise
+        finally:
+            Metrics.Observe(name, time.perf_counter() - start, result=result, **labels)
+
+    @staticmethod
+    def Reset() -> None:
+        with Metrics.__Lock:
+            Metrics.__Counters.clear()
+            Metrics.__Timers.clear()
+
+    @staticmethod
+    def GetSummary() -> dict:
+        '''all metrics as plain data, ready for json.dumps'''
+        summary = {}
+        with Metrics.__Lock:
+            for name, series in sorted(Metrics.__Counters.items()):
+                summary[name] = [
+                    {'labels': dict(labels), 'value': value} for labels, value in series.items()
+                ]
+            for name, series in sorted(Metrics.__Timers.items()):
+                summary[name] = [
+                    {
+                        'labels': dict(labels),
+                        'count': timer.Count,
+                        'sum_seconds': round(timer.Sum, 6),
+                        'max_seconds': round(timer.Max, 6),
+                        'mean_seconds': round(timer.Sum / timer.Count, 6),
+                    }
+                    for labels, timer in series.items()
+                ]
+        return summary
+
+    @staticmethod
+    def __FormatLabels(labels: Labels) -> str:
+        if not labels:
+            return ''
+        escaped = [
+            (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels
+        ]
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+    @staticmethod
+    def FormatPrometheus() -> str:
+        '''the Prometheus text exposition format; timers become summaries without quantiles'''
+        lines: List[str] = []
+        with Metrics.__Lock:
+            for name, series in sorted(Metrics.__Counters.items()):
+                fullName = Metrics.Prefix + name
+                if name in Metrics.__Help:
+                    lines.append(f'# HELP {fullName} {Metrics.__Help[name]}')
+                lines.append(f'# TYPE {fullName} counter')
+                for labels, value in series.items():
+                    # Byte counts get large; keep them exact rather than in exponent notation.
+                    value = int(value) if float(value).is_integer() else value
+                    lines.append(f'{fullName}{Metrics.__FormatLabels(labels)} {value}')
+            for name, series in sorted(Metrics.__Timers.items()):
+                fullName = Metrics.Prefix + name
+                if name in Metrics.__Help:
+                    lines.append(f'# HELP {fullName} {Metrics.__Help[name]}')
+                lines.append(f'# TYPE {fullName} summary')
+                for labels, timer in series.items():
+                    formattedLabels = Metrics.__FormatLabels(labels)
+                    lines.append(f'{fullName}_count{formattedLabels} {timer.Count}')
+                    lines.append(f'{fullName}_sum{formattedLabels} {timer.Sum:.6f}')
+        return '\n'.join(lines) + '\n'
@@ -1,11 +1,20 @@
+import contextlib
 import dataclasses
+import json
 import os
-from typing import List, Union
+import tempfile
+import threading
+from typing import Dict, Iterator, List, Tuple, Union
 
-from dataclasses_json import dataclass_json
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 
-@dataclass_json
+# The settings are read on every run, so they are (de)serialized by hand instead of with dataclasses_json,
+# which takes longer to import than the rest of the CLI's startup. The JSON is the same.
 @dataclasses.dataclass
 class User:
     Email: str = ""
@@ -16,6 +25,15 @@ class User:
     UserId: str = ""
     UserKey: str = ""
 
+    @staticmethod
+    def from_dict(data: dict) -> "User":
+        # Unknown keys are ignored, so settings written by newer versions can still be read.
+        fieldNames = [field.name for field in dataclasses.fields(User)]
+        return User(**{key: value for key, value in data.items() if key in fieldNames})
+
+    def to_dict(self) -> dict:
+        return dataclasses.asdict(self)
+
     def AreAuthenticationSettingsSet(self) -> bool:
         return len(self.DeviceId) > 0 and len(self.AccessToken) > 0 and len(self.RefreshToken) > 0
 
@@ -23,11 +41,18 @@ class User:
         return len(self.UserId) > 0 and len(self.UserKey) > 0
 
 
-@dataclass_json
 @dataclasses.dataclass
 class UserList:
     users: List[User] = dataclasses.field(default_factory=list)
 
+    @staticmethod
+    def from_json(jsonText: str) -> "UserList":
+        data = json.loads(jsonText)
+        return UserList(users=[User.from_dict(user) for user in data.get("users", [])])
+
+    def to_json(self, indent: Union[int, None] = None) -> str:
+        return json.dumps(dataclasses.asdict(self), indent=indent)
+
     def getUser(self, identifier: str) -> Union[User, None]:
         for user in self.users:
             if (
@@ -47,21 +72,159 @@ class UserList:
         return None
 
 
+# Several kobodl processes may use the same settings file, e.g. a cron job and the web server. Writes are
+# atomic (temporary file and rename) and serialized by a lock file, and before writing, the changes other
+# processes made since we last read the file are merged in, so neither side loses refreshed tokens.
 class Settings:
     def __init__(self, configpath=None):
         self.SettingsFilePath = configpath or Settings.__GetCacheFilePath()
+        self.LockFilePath = self.SettingsFilePath + ".lock"
+        # Library and other caches live next to the config file so docker volumes keep them.
+        self.CacheDirPath = os.path.join(
+            os.path.dirname(os.path.abspath(self.SettingsFilePath)), "kobodl_cache"
+        )
+        # Guards UserList against concurrent merges; __WriteLock lets only one thread write at a time.
+        self.__Lock = threading.RLock()
+        self.__WriteLock = threading.Lock()
+        self.__RequestedSaves = 0
+        self.__CompletedSaves = 0
+        # What the file looked like when we last read or wrote it.
+        self.__FileStat: Union[Tuple[int, int, int], None] = None
+        self.__Snapshot: Dict[str, dict] = {}
         self.UserList = self.Load()
 
     def Load(self) -> UserList:
-        if not os.path.isfile(self.SettingsFilePath):
-            return UserList()
-        with open(self.SettingsFilePath, "r") as f:
-            jsonText = f.read()
-            return UserList.from_json(jsonText)
+        with self.__Lock:
+            if not os.path.isfile(self.SettingsFilePath):
+                self.__FileStat = None
+                self.__Snapshot = {}
+                return UserList()
+            with open(self.SettingsFilePath, "r") as f:
+                fileStat = Settings.__GetFileStat(os.fstat(f.fileno()))
+                jsonText = f.read()
+            userList = UserList.from_json(jsonText)
+            self.__FileStat = fileStat
+            self.__Snapshot = Settings.__MakeSnapshot(userList)
+            return userList
+
+    def Reload(self) -> bool:
+        """
+        pick up changes other processes made to the settings file, if its mtime changed
+        users are updated in place, so references to them stay valid; returns whether anything was read
+        """
+        with self.__Lock:
+            if not self.__HasFileChanged():
+                return False
+            self.__MergeFromFile()
+            return True
 
     def Save(self) -> None:
-        with open(self.SettingsFilePath, "w") as f:
-            f.write(self.UserList.to_json(indent=4))
+        with self.__Lock:
+            self.__RequestedSaves += 1
+            requested = self.__RequestedSaves
+
+        with self.__WriteLock:
+            # Saves requested while another thread was writing are all covered by the next single write.
+            if self.__CompletedSaves >= requested:
+                return
+            with self.__LockFile():
+                with self.__Lock:
+                    covered = self.__RequestedSaves
+                    if self.__HasFileChanged():
+                        self.__MergeFromFile()
+                    jsonText = self.UserList.to_json(indent=4)
+                    snapshot = Settings.__MakeSnapshot(self.UserList)
+                fileStat = self.__WriteFile(jsonText)
+                with self.__Lock:
+                    self.__FileStat = fileStat
+                    self.__Snapshot = snapshot
+            self.__CompletedSaves = covered
+
+    def GetCachePath(self, fileName: str) -> str:
+        return os.path.join(self.CacheDirPath, fileName)
+
+    @staticmethod
+    def __GetFileStat(stat: os.stat_result) -> Tuple[int, int, int]:
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    @staticmethod
+    def __GetUserKey(user: User) -> str:
+        return user.DeviceId or user.Email
+
+    @staticmethod
+    def __MakeSnapshot(userList: UserList) -> Dict[str, dict]:
+        return {Settings.__GetUserKey(user): user.to_dict() for user in userList.users}
+
+    def __HasFileChanged(self) -> bool:
+        try:
+            fileStat = Settings.__GetFileStat(os.stat(self.SettingsFilePath))
+        except FileNotFoundError:
+            return self.__FileStat is not None
+        return fileStat != self.__FileStat
+
+    def __MergeFromFile(self) -> None:
+        # A three-way merge between what we last read or wrote (the snapshot), what is in memory now and what
+        # is in the file now. Users that only changed on one side take that side's version.
+        snapshot = self.__Snapshot
+        fileUsers = {Settings.__GetUserKey(user): user for user in self.Load().users}
+        users = []
+        for user in self.UserList.users:
+            key = Settings.__GetUserKey(user)
+            if snapshot.get(key) != user.to_dict():
+                # Added or changed here, keep it.
+                users.append(user)
+                continue
+            fileUser = fileUsers.get(key)
+            if fileUser is None:
+                # Removed by another process.
+                continue
+            for field in dataclasses.fields(User):
+                setattr(user, field.name, getattr(fileUser, field.name))
+            users.append(user)
+        keys = {Settings.__GetUserKey(user) for user in self.UserList.users}
+        for key, fileUser in fileUsers.items():
+            if key not in keys and key not in snapshot:
+                # Added by another process.
+                users.append(fileUser)
+        self.UserList.users[:] = users
+
+    def __WriteFile(self, jsonText: str) -> Tuple[int, int, int]:
+        directory = os.path.dirname(os.path.abspath(self.SettingsFilePath))
+        fd, temporaryPath = tempfile.mkstemp(dir=directory, prefix=".kobodl-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(jsonText)
+                f.flush()
+                os.fsync(f.fileno())
+                fileStat = Settings.__GetFileStat(os.fstat(f.fileno()))
+            os.replace(temporaryPath, self.SettingsFilePath)
+        except BaseException:
+            os.remove(temporaryPath)
+            raise
+        return fileStat
+
+    @contextlib.contextmanager
+    def __LockFile(self) -> Iterator[None]:
+        with open(self.LockFilePath, "a+") as lockFile:
+            if fcntl is not None:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+            else:
+                lockFile.seek(0)
+                while True:
+                    try:
+                        # Gives up after about 10 seconds, hence the loop.
+                        msvcrt.locking(lockFile.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+                else:
+                    lockFile.seek(0)
+                    msvcrt.locking(lockFile.fileno(), msvcrt.LK_UNLCK, 1)
 
     @staticmethod
     def __GetCacheFilePath() -> str:
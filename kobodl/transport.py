@@ -0,0 +1,282 @@
+import dataclasses
+import email.utils
+import random
+import threading
+import time
+import urllib.parse
+import weakref
+from typing import Dict, Tuple, Union
+
+import requests
+
+from kobodl.debug import debug_data
+from kobodl.metrics import Metrics
+
+
+@dataclasses.dataclass
+class TransportPolicy:
+    # (connect, read) timeouts in seconds, used when a request doesn't set its own.
+    Timeout: Tuple[float, float] = (10, 60)
+    MaxRetries: int = 4
+    # The n-th retry waits a random time between 0 and min(BackoffMax, BackoffBase * 2 ** n) seconds.
+    BackoffBase: float = 1.0
+    BackoffMax: float = 30.0
+    # Retry-After is followed up to this many seconds; longer waits are cut short.
+    RetryAfterMax: float = 120.0
+    # How many requests may be in flight to one host at a time, over all sessions of the process. A streamed
+    # response keeps its slot until its body has been read or it is closed.
+    MaxConnectionsPerHost: int = 8
+    RetryStatuses: Tuple[int, ...] = (
+        requests.codes.too_many_requests,  # 429
+        requests.codes.internal_server_error,  # 500
+        requests.codes.bad_gateway,  # 502
+        requests.codes.service_unavailable,  # 503
+        requests.codes.gateway_timeout,  # 504
+    )
+    # Other methods are only retried when the server said it didn't process the request (429, 503).
+    IdempotentMethods: Tuple[str, ...] = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class RateLimiter:
+    '''
+    Token bucket limiting the combined throughput of every download, whichever thread it runs in.
+    A rate of 0 means unlimited. The rate can be changed at any time, e.g. while the web server is running.
+    '''
+
+    # Rates are given in bytes per second, with an optional k, M or G (powers of 1024) suffix, like curl's.
+    RateUnits = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}
+
+    def __init__(self, bytesPerSecond: float = 0):
+        self.__Lock = threading.Lock()
+        self.BytesPerSecond = bytesPerSecond
+        self.__Tokens = 0.0
+        self.__Updated = time.monotonic()
+
+    @staticmethod
+    def ParseRate(rate: str) -> float:
+        rate = rate.strip().lower()
+        unit = rate[-1:] if rate[-1:] in RateLimiter.RateUnits else ''
+        value = float(rate[: len(rate) - len(unit)])
+        if value < 0:
+            raise ValueError(f'negative rate: {rate}')
+        return value * RateLimiter.RateUnits[unit]
+
+    def __Refill(self) -> None:
+        now = time.monotonic()
+        # At most one second worth of bytes is saved up, so an idle period doesn't allow a long burst.
+        self.__Tokens = min(
+            self.BytesPerSecond, self.__Tokens + (now - self.__Updated) * self.BytesPerSecond
+        )
+        self.__Updated = now
+
+    def SetRate(self, bytesPerSecond: float) -> None:
+        with self.__Lock:
+            self.__Refill()
+            self.BytesPerSecond = bytesPerSecond
+            self.__Tokens = min(self.__Tokens, bytesPerSecond)
+
+    def Consume(self, size: int) -> None:
+        '''account for size bytes that were just transferred, waiting as needed to stay under the rate'''
+        with self.__Lock:
+            if self.BytesPerSecond <= 0:
+                return
+            self.__Refill()
+            # The bucket can go into debt: a chunk larger than the bucket still gets through, and whoever
+            # comes next waits until the debt is paid back.
+            self.__Tokens -= size
+            delay = -self.__Tokens / self.BytesPerSecond if self.__Tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Transport:
+    '''
+    The process-wide HTTP policy: every Kobo session, whichever thread it belongs to, shares the
+    per-host limits kept here. Requests, retries and failures are counted in Metrics.
+    '''
+
+    Policy = TransportPolicy()
+    RateLimiter = RateLimiter()
+    __HostSemaphores: Dict[str, threading.BoundedSemaphore] = {}
+    __HostSemaphoresLock = threading.Lock()
+
+    @staticmethod
+    def GetHostSemaphore(host: str) -> threading.BoundedSemaphore:
+        with Transport.__HostSemaphoresLock:
+            semaphore = Transport.__HostSemaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(Transport.Policy.MaxConnectionsPerHost)
+                Transport.__HostSemaphores[host] = semaphore
+            return semaphore
+
+    @staticmethod
+    def CountRetry(host: str, reason: str, delay: float) -> None:
+        Metrics.Increment('http_retries_total', host=host, reason=reason)
+        Metrics.Increment('http_backoff_seconds_total', delay, host=host)
+
+    @staticmethod
+    def CountFailure(host: str, reason: str) -> None:
+        Metrics.Increment('http_failures_total', host=host, reason=reason)
+
+    @staticmethod
+    def GetBackoff(retry: int) -> float:
+        policy = Transport.Policy
+        # "Full jitter", so that workers that failed together don't all come back at the same moment.
+        return random.uniform(0, min(policy.BackoffMax, policy.BackoffBase * 2**retry))
+
+    @staticmethod
+    def GetRetryAfter(response: requests.Response) -> Union[float, None]:
+        retryAfter = response.headers.get('Retry-After')
+        if not retryAfter:
+            return None
+        try:
+            delay = float(retryAfter)
+        except ValueError:
+            try:
+                date = email.utils.parsedate_to_datetime(retryAfter)
+            except (TypeError, ValueError):
+                return None
+            delay = date.timestamp() - time.time()
+        return min(max(delay, 0.0), Transport.Policy.RetryAfterMax)
+
+
+class KoboSession(requests.Session):
+    '''
+    requests.Session with timeouts, retries with backoff for 429, 5xx and connection errors, and a limit on
+    concurrent requests per host. It is used for storeapi.kobo.com as well as the download hosts; redirects
+    (e.g. storedownloads.kobo.com to S3) go through send too, so every hop gets the same treatment.
+    '''
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = Transport.Policy.Timeout
+        allowRedirects = kwargs.pop('allow_redirects', True)
+
+        # requests.Session.send runs the response hooks itself, which would be while the host semaphore is
+        # held. The reauthentication hook in kobo.py sends the token refresh to the same host, so with every
+        # slot taken by a 401 that would wait forever. The hooks are dispatched after releasing it instead.
+        hooks = request.hooks
+        request.hooks = requests.hooks.default_hooks()
+        try:
+            response = self.__SendWithRetries(request, **kwargs)
+        finally:
+            request.hooks = hooks
+        response = requests.hooks.dispatch_hook(
+            'response', hooks, response, **self.__GetHookKwargs(request, kwargs)
+        )
+        if not allowRedirects:
+            return response
+
+        # Redirects are followed here rather than by requests.Session.send, so that no host semaphore is held
+        # while waiting for another one. resolve_redirects sends every hop through send again.
+        history = list(self.resolve_redirects(response, request, **kwargs))
+        if history:
+            history.insert(0, response)
+            response = history.pop()
+            response.history = history
+        return response
+
+    def __GetHookKwargs(self, request: requests.PreparedRequest, kwargs: dict) -> dict:
+        # The same arguments requests.Session.send gives hooks, which use them to send the request again.
+        hookKwargs = dict(kwargs)
+        hookKwargs.setdefault('stream', self.stream)
+        hookKwargs.setdefault('verify', self.verify)
+        hookKwargs.setdefault('cert', self.cert)
+        if 'proxies' not in hookKwargs:
+            hookKwargs['proxies'] = requests.utils.resolve_proxies(
+                request, self.proxies, self.trust_env
+            )
+        return hookKwargs
+
+    def __SendWithRetries(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        policy = Transport.Policy
+        host = urllib.parse.urlsplit(request.url).netloc
+        semaphore = Transport.GetHostSemaphore(host)
+
+        retry = 0
+        while True:
+            try:
+                semaphore.acquire()
+                try:
+                    # Only the request itself is timed, not the wait for the semaphore.
+                    start = time.perf_counter()
+                    try:
+                        response = super().send(request, allow_redirects=False, **kwargs)
+                    finally:
+                        elapsed = time.perf_counter() - start
+                        Metrics.Observe('http_request_seconds', elapsed, host=host)
+                except:
+                    semaphore.release()
+                    raise
+                KoboSession.__ReleaseWithBody(response, semaphore, kwargs.get('stream', False))
+            except (requests.ConnectionError, requests.Timeout) as err:
+                Metrics.Increment('http_requests_total', host=host, status=type(err).__name__)
+                reason = type(err).__name__
+                if retry >= policy.MaxRetries or not KoboSession.__CanRetry(request, None):
+                    Transport.CountFailure(host, reason)
+                    raise
+                delay = Transport.GetBackoff(retry)
+            else:
+                Metrics.Increment('http_requests_total', host=host, status=response.status_code)
+                if response.status_code not in policy.RetryStatuses:
+                    return response
+                reason = str(response.status_code)
+                if retry >= policy.MaxRetries or not KoboSession.__CanRetry(request, response):
+                    Transport.CountFailure(host, reason)
+                    return response
+                retryAfter = Transport.GetRetryAfter(response)
+                delay = Transport.GetBackoff(retry) if retryAfter is None else retryAfter
+                # Release the connection before waiting.
+                response.close()
+
+            debug_data('Retrying request', request.method, request.url, reason, delay)
+            Transport.CountRetry(host, reason, delay)
+            time.sleep(delay)
+            retry += 1
+
+    @staticmethod
+    def __ReleaseWithBody(
+        response: requests.Response, semaphore: threading.BoundedSemaphore, stream: bool
+    ) -> None:
+        '''release the host semaphore once the body of response has been read or response is closed'''
+        if not stream:
+            # requests.Session.send has read the body already.
+            semaphore.release()
+            return
+
+        # Called at most once, whichever comes first; also when the response is garbage collected unread.
+        release = weakref.finalize(response, semaphore.release)
+        iterContent = response.iter_content
+        close = response.close
+
+        def iterContentAndRelease(*args, **kwargs):
+            try:
+                yield from iterContent(*args, **kwargs)
+            finally:
+                release()
+
+        def closeAndRelease():
+            try:
+                close()
+            finally:
+                release()
+
+        # response.content, .text and .json() read the body through iter_content as well.
+        response.iter_content = iterContentAndRelease
+        response.close = closeAndRelease
+        if response.status_code >= 400:
+            # Error bodies are short. Reading them now gives the slot back even when the caller raises and
+            # keeps the response around in the exception.
+            response.content
+
+    @staticmethod
+    def __CanRetry(
+        request: requests.PreparedRequest, response: Union[requests.Response, None]
+    ) -> bool:
+        if request.method in Transport.Policy.IdempotentMethods:
+            return True
+        # Nothing was processed in these cases, so even a POST can be sent again.
+        return response is not None and response.status_code in [
+            requests.codes.too_many_requests,  # 429
+            requests.codes.service_unavailable,  # 503
+        ]